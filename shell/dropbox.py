@@ -21,11 +21,14 @@
 #
 from __future__ import with_statement
 
+import collections
 import errno
+import json
 import locale
 import optparse
 import os
 import platform
+import shlex
 import shutil
 import socket
 import subprocess
@@ -49,6 +52,7 @@ except ImportError:
     except ImportError:
         gpgme = None
 
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing, contextmanager
 from io import BytesIO
 from operator import methodcaller
@@ -74,6 +78,13 @@ DROPBOX_DIST_PATH = "%s/.dropbox-dist" % PARENT_DIR
 DROPBOXD_PATH = os.path.join(DROPBOX_DIST_PATH, "dropboxd")
 DESKTOP_FILE = "/usr/share/applications/dropbox.desktop"
 
+# How many requests bulk lookups keep in flight on one daemon connection
+PIPELINE_DEPTH = 64
+# How many daemon connections bulk lookups are spread over
+POOL_SIZE = 4
+# Read buffer for daemon replies, which can run to many long lines
+READ_BUFFER_SIZE = 64 * 1024
+
 enc = locale.getpreferredencoding()
 
 # Available from https://linux.dropbox.com/fedora/rpm-public-key.asc
@@ -597,29 +608,77 @@ else:
 
         console_print()
 
+# One ticker serves the whole invocation. Requests mark themselves busy
+# with begin()/end(), and the ticker only draws once something has been
+# waiting on the daemon for longer than `delay` seconds.
 class CommandTicker(threading.Thread):
-    def __init__(self):
+    ticks = ['[.  ]', '[.. ]', '[...]', '[ ..]', '[  .]']
+
+    def __init__(self, delay=1.0):
         threading.Thread.__init__(self)
+        self.daemon = True
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.waiting_since = 0
+        self.shown = False
         self.stop_event = threading.Event()
 
+    def begin(self):
+        with self.lock:
+            if self.waiting == 0:
+                self.waiting_since = time.time()
+            self.waiting += 1
+
+    # Clears the ticker as soon as the last wait ends, so it is gone before
+    # the caller prints its result
+    def end(self):
+        with self.lock:
+            self.waiting -= 1
+            if self.waiting == 0:
+                self.__clear()
+
     def stop(self):
         self.stop_event.set()
+        self.join()
+        with self.lock:
+            self.__clear()
+
+    # Call with the lock held
+    def __clear(self):
+        if self.shown:
+            sys.stderr.write("\r%s\r" % (" " * len(self.ticks[0])))
+            sys.stderr.flush()
+            self.shown = False
 
     def run(self):
-        ticks = ['[.  ]', '[.. ]', '[...]', '[ ..]', '[  .]', '[   ]']
         i = 0
-        first = True
-        while True:
-            self.stop_event.wait(0.25)
-            if self.stop_event.isSet(): break
-            if i == len(ticks):
-                first = False
-                i = 0
-            if not first:
-                sys.stderr.write("\r%s\r" % ticks[i])
-                sys.stderr.flush()
-            i += 1
-        sys.stderr.flush()
+        while not self.stop_event.wait(0.25):
+            with self.lock:
+                if self.waiting > 0 and time.time() - self.waiting_since >= self.delay:
+                    sys.stderr.write("\r%s\r" % self.ticks[i % len(self.ticks)])
+                    sys.stderr.flush()
+                    self.shown = True
+                    i += 1
+
+command_ticker = None
+command_ticker_lock = threading.Lock()
+
+# Starts the invocation's ticker on first use. There's nothing to watch
+# when stderr isn't a terminal, so then there is no ticker at all.
+def get_command_ticker():
+    global command_ticker
+    with command_ticker_lock:
+        if command_ticker is None and sys.stderr.isatty():
+            command_ticker = CommandTicker()
+            command_ticker.start()
+    return command_ticker
+
+def stop_command_ticker():
+    global command_ticker
+    if command_ticker is not None:
+        command_ticker.stop()
+        command_ticker = None
 
 
 class DropboxCommand(object):
@@ -635,15 +694,23 @@ class DropboxCommand(object):
             self.s.connect(os.path.expanduser('~/.dropbox/command_socket'))
         except socket.error:
             raise DropboxCommand.CouldntConnectError()
-        self.f = self.s.makefile("rw", 4096)
+        # Separate readers and writers: writing to a shared text file drops
+        # whatever replies it has already read ahead, which breaks pipelining
+        self.r = self.s.makefile("r", READ_BUFFER_SIZE)
+        self.f = self.s.makefile("w", 4096)
 
     def close(self):
-        self.f.close()
+        self.r.close()
+        try:
+            self.f.close()
+        except socket.error:
+            # Whatever was still buffered has nowhere to go
+            pass
         self.s.close()
 
     def __readline(self):
         try:
-            toret = self.f.readline().rstrip("\n")
+            toret = self.r.readline().rstrip("\n")
         except socket.error:
             raise DropboxCommand.BadConnectionError()
         if toret == '':
@@ -651,52 +718,48 @@ class DropboxCommand(object):
         else:
             return toret
 
-    # atttribute doesn't exist, i know what you want
-    def send_command(self, name, args):
-        self.f.write(name)
-        self.f.write("\n")
-        self.f.writelines(("\t".join([k] + ([v]
+    def __write_command(self, name, args):
+        # Build the whole request first, so a path that can't be encoded
+        # never leaves half a request in the buffer
+        request = (name + "\n" +
+                   "".join(("\t".join([k] + ([v]
                                             if isinstance(v, str) else
                                             list(v))) + "\n")
-                          for k,v in args.items())
-        self.f.write("done\n")
-
-        self.f.flush()
+                           for k,v in args.items()) +
+                   "done\n")
+        try:
+            self.f.write(request)
+        except socket.error:
+            raise DropboxCommand.BadConnectionError()
 
-        # Start a ticker
-        ticker_thread = CommandTicker()
-        ticker_thread.start()
+    # A daemon that has gone away usually shows up here first, as a
+    # broken pipe or a reset connection
+    def __flush(self):
+        try:
+            self.f.flush()
+        except socket.error:
+            raise DropboxCommand.BadConnectionError()
 
+    # Reads one reply, yielding a (key, values) record per line as it
+    # arrives. Error replies raise CommandError once all their lines are in.
+    def __read_records(self):
         # This is the potentially long-running call.
         try:
             ok = self.__readline() == "ok"
         except KeyboardInterrupt:
             raise DropboxCommand.BadConnectionError("Keyboard interruption detected")
-        finally:
-            # Tell the ticker to stop.
-            ticker_thread.stop()
-            ticker_thread.join()
 
         if ok:
-            toret = {}
-            for i in range(21):
-                if i == 20:
-                    raise Exception("close this connection!")
-
+            while True:
                 line = self.__readline()
                 if line == "done":
-                    break
-
-                argval = line.split("\t")
-                toret[argval[0]] = argval[1:]
+                    return
 
-            return toret
+                key, tab, values = line.partition("\t")
+                yield key, (values.split("\t") if tab else [])
         else:
             problems = []
-            for i in range(21):
-                if i == 20:
-                    raise Exception("close this connection!")
-
+            while True:
                 line = self.__readline()
                 if line == "done":
                     break
@@ -705,6 +768,108 @@ class DropboxCommand(object):
 
             raise DropboxCommand.CommandError("\n".join(problems))
 
+    def __read_reply(self):
+        toret = {}
+        for key, values in self.__read_records():
+            toret.setdefault(key, []).extend(values)
+
+        return toret
+
+    # atttribute doesn't exist, i know what you want
+    def send_command(self, name, args):
+        self.__write_command(name, args)
+        self.__flush()
+
+        ticker = get_command_ticker()
+        if ticker is not None:
+            ticker.begin()
+
+        try:
+            return self.__read_reply()
+        finally:
+            if ticker is not None:
+                ticker.end()
+
+    # Like send_command, but yields the reply's (key, values) records as
+    # they are read instead of collecting them. Stopping early leaves the
+    # rest of the reply unread, so close the connection afterwards.
+    def stream_command(self, name, args):
+        self.__write_command(name, args)
+        self.__flush()
+
+        ticker = get_command_ticker()
+        if ticker is not None:
+            ticker.begin()
+
+        try:
+            for record in self.__read_records():
+                yield record
+        finally:
+            if ticker is not None:
+                ticker.end()
+
+    # Sends one `name` request per dict in args_iter, writing up to depth
+    # of them before waiting on the oldest reply, and yields the replies in
+    # order. Failed requests yield their CommandError (or UnicodeEncodeError)
+    # instead of raising, so one bad path doesn't end the batch. Stopping
+    # early leaves replies unread, so close the connection afterwards.
+    def send_commands(self, name, args_iter, depth=PIPELINE_DEPTH):
+        # The whole batch counts as one wait, so there is no per-request cost
+        ticker = get_command_ticker()
+        if ticker is not None:
+            ticker.begin()
+
+        try:
+            for reply in self.send_requests(((name, args) for args in args_iter), depth):
+                yield reply
+        finally:
+            if ticker is not None:
+                ticker.end()
+
+    # Like send_commands, but for a mix of commands: requests_iter gives
+    # (name, args) pairs. An exception in their place is yielded back in
+    # its turn without sending anything. There's no ticker, as the caller
+    # may well be the one keeping requests_iter waiting.
+    def send_requests(self, requests_iter, depth=PIPELINE_DEPTH):
+        requests_iter = iter(requests_iter)
+        in_flight = collections.deque()
+        exhausted = False
+
+        while True:
+            while not exhausted and len(in_flight) < depth:
+                try:
+                    request = next(requests_iter)
+                except StopIteration:
+                    exhausted = True
+                    break
+
+                if isinstance(request, Exception):
+                    in_flight.append(request)
+                    continue
+
+                name, args = request
+                try:
+                    self.__write_command(name, args)
+                    in_flight.append(None)
+                except UnicodeEncodeError as e:
+                    in_flight.append(e)
+
+            if not in_flight:
+                return
+
+            self.__flush()
+
+            error = in_flight.popleft()
+            if error is None:
+                try:
+                    reply = self.__read_reply()
+                except DropboxCommand.CommandError as e:
+                    reply = e
+            else:
+                reply = error
+
+            yield reply
+
     # this is the hotness, auto marshalling
     def __getattr__(self, name):
         try:
@@ -715,6 +880,85 @@ class DropboxCommand(object):
             self.__setattr__(name, __spec_command)
             return __spec_command
 
+# Spreads bulk requests over up to `size` daemon connections. Each worker
+# thread opens its own DropboxCommand the first time it needs one, and a
+# fresh one if that goes bad mid-batch.
+class DropboxCommandPool(object):
+    def __init__(self, size=POOL_SIZE, timeout=5):
+        self.size = size
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+        self.executor = None
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+        for dc in self.connections:
+            dc.close()
+        self.connections = []
+
+    def __connection(self):
+        dc = getattr(self.local, 'dc', None)
+        if dc is None:
+            dc = DropboxCommand(self.timeout)
+            with self.lock:
+                self.connections.append(dc)
+            self.local.dc = dc
+        return dc
+
+    def __reconnect(self):
+        dc = self.local.dc
+        self.local.dc = None
+        with self.lock:
+            self.connections.remove(dc)
+        try:
+            dc.close()
+        except socket.error:
+            pass
+        return self.__connection()
+
+    def __send_block(self, name, block, depth):
+        try:
+            return list(self.__connection().send_commands(name, block, depth))
+        except (DropboxCommand.BadConnectionError, DropboxCommand.EOFError):
+            # Lookups are safe to repeat, so retry the whole block once
+            return list(self.__reconnect().send_commands(name, block, depth))
+
+    # Same contract as DropboxCommand.send_commands: one reply per args
+    # dict, yielded in order, with failed requests yielded as errors.
+    def send_commands(self, name, args_iter, depth=PIPELINE_DEPTH):
+        args_list = list(args_iter)
+        blocks = [args_list[i:i + depth] for i in range(0, len(args_list), depth)]
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.size)
+
+        for replies in self.executor.map(lambda block: self.__send_block(name, block, depth), blocks):
+            for reply in replies:
+                yield reply
+
+# Yields the icon_overlay_file_status reply for each path, in order, with
+# None for paths that don't exist. Callers that already know which paths
+# exist can pass that in as `exists` to save a stat per path.
+def icon_overlay_file_statuses(dc, file_paths, depth=PIPELINE_DEPTH, exists=None):
+    if exists is None:
+        exists = [os.path.exists(file_path) for file_path in file_paths]
+    replies = dc.send_commands("icon_overlay_file_status",
+                               ({'path': file_path} for file_path, file_exists in zip(file_paths, exists) if file_exists),
+                               depth)
+
+    for file_exists in exists:
+        yield next(replies) if file_exists else None
+
+# Rejects counts that must be at least 1, e.g. pipeline depths, which would
+# otherwise fail deep inside the request loop
+def check_at_least_one(oparser, options, *names):
+    for name in names:
+        if getattr(options, name) < 1:
+            oparser.error("--%s must be at least 1" % name)
+
 commands = {}
 aliases = {}
 
@@ -779,10 +1023,9 @@ def columnize(list, display_list=None, display_width=None):
                           ", ".join(map(str, non_str)))
 
     if not display_width:
-        d = os.popen('stty size', 'r').read().split()
-        if d:
-            display_width = int(d[1])
-        else:
+        # 0 when stdout isn't a terminal and COLUMNS isn't set
+        display_width = shutil.get_terminal_size((0, 0)).columns
+        if not display_width:
             for item in list:
                 console_print(item)
             return
@@ -795,18 +1038,27 @@ def columnize(list, display_list=None, display_width=None):
         console_print(display_list[0])
         return
 
-    for nrows in range(1, len(list)):
-        ncols = (size+nrows-1) // nrows
+    widths = [len(x) for x in list]
+
+    # maxima[k][i] is the widest of widths[i:i+2**k], so the width of any
+    # column is the larger of two lookups instead of a scan down it
+    maxima = [widths]
+    while 1 << len(maxima) <= size:
+        half = 1 << (len(maxima) - 1)
+        previous = maxima[-1]
+        maxima.append([max(a, b) for a, b in zip(previous, previous[half:])])
+
+    def widest(start, end):
+        k = (end - start).bit_length() - 1
+        return max(maxima[k][start], maxima[k][end - (1 << k)])
+
+    # Whether a layout fits isn't monotonic in the number of rows, so try
+    # them in order; each try only looks at columns until the line overflows
+    for nrows in range(1, size):
         colwidths = []
         totwidth = -2
-        for col in range(ncols):
-            colwidth = 0
-            for row in range(nrows):
-                i = row + nrows*col
-                if i >= size:
-                    break
-                x = list[i]
-                colwidth = max(colwidth, len(x))
+        for start in range(0, size, nrows):
+            colwidth = widest(start, min(start + nrows, size))
             colwidths.append(colwidth)
             totwidth += colwidth + 2
             if totwidth > display_width:
@@ -814,33 +1066,18 @@ def columnize(list, display_list=None, display_width=None):
         if totwidth <= display_width:
             break
     else:
-        nrows = len(list)
-        ncols = 1
+        nrows = size
         colwidths = [0]
-    lines = []
+
+    # Pad the display strings directly, the widths are already known
     for row in range(nrows):
         texts = []
-        display_texts = []
-        for col in range(ncols):
+        for col in range(len(colwidths)):
             i = row + nrows*col
             if i >= size:
-                x = ""
-                y = ""
-            else:
-                x = list[i]
-                y = display_list[i]
-            texts.append(x)
-            display_texts.append(y)
-        while texts and not texts[-1]:
-            del texts[-1]
-        original_texts = texts[:]
-        for col in range(len(texts)):
-            texts[col] = texts[col].ljust(colwidths[col])
-            texts[col] = texts[col].replace(original_texts[col], display_texts[col])
-        line = "  ".join(texts)
-        lines.append(line)
-    for line in lines:
-        console_print(line)
+                break
+            texts.append(display_list[i] + " " * (colwidths[col] - widths[i]))
+        console_print("  ".join(texts))
 
 @command
 def update(args):
@@ -857,23 +1094,28 @@ normally, as Dropbox automatically updates itself.
 @alias('stat')
 def filestatus(args):
     """get current sync status of one or more files
-dropbox filestatus [-l] [-a] [FILE]...
+dropbox filestatus [-l] [-a] [-p N] [-c N] [FILE]...
 
 Prints the current status of each FILE.
 
 options:
-  -l --list  Prints out information in a format similar to ls. Works best when your console supports color :)
-  -a --all   Do not ignore entries starting with "."
+  -l --list           Prints out information in a format similar to ls. Works best when your console supports color :)
+  -a --all            Do not ignore entries starting with "."
+  -p --pipeline N     Keep up to N status requests in flight on each connection (default 64)
+  -c --connections N  Spread status requests over up to N connections (default 4)
     """
     global enc
 
     oparser = optparse.OptionParser()
     oparser.add_option("-l", "--list", action="store_true", dest="list")
     oparser.add_option("-a", "--all", action="store_true", dest="all")
+    oparser.add_option("-p", "--pipeline", type="int", dest="pipeline", default=PIPELINE_DEPTH)
+    oparser.add_option("-c", "--connections", type="int", dest="connections", default=POOL_SIZE)
     (options, args) = oparser.parse_args(args)
+    check_at_least_one(oparser, options, "pipeline", "connections")
 
     try:
-        with closing(DropboxCommand()) as dc:
+        with closing(DropboxCommandPool(options.connections)) as dc:
             if options.list:
                 # Listing.
 
@@ -896,29 +1138,28 @@ options:
                 dirs.sort(key=methodcaller('lower'))
                 nondirs.sort(key=methodcaller('lower'))
 
-                # Gets a string representation for a path.
-                def path_to_string(file_path):
-                    if not os.path.exists(file_path):
-                        path = "%s (File doesn't exist!)" % os.path.basename(file_path)
+                # Colour support doesn't change between entries, so check it once.
+                env_term = os.environ.get('TERM','')
+                supports_color = (sys.stderr.isatty() and (
+                                    env_term.startswith('vt') or
+                                    env_term.startswith('linux') or
+                                    'xterm' in env_term or
+                                    'color' in env_term
+                                    )
+                                 )
+
+                # Gets a string representation for an entry name, given its status reply.
+                def path_to_string(path, reply):
+                    if reply is None:
+                        path = "%s (File doesn't exist!)" % path
                         return (path, path)
-                    try:
-                        status = dc.icon_overlay_file_status(path=file_path).get('status', [None])[0]
-                    except DropboxCommand.CommandError as e:
-                        path =  "%s (%s)" % (os.path.basename(file_path), e)
+                    if isinstance(reply, DropboxCommand.CommandError):
+                        path =  "%s (%s)" % (path, reply)
                         return (path, path)
-
-                    env_term = os.environ.get('TERM','')
-                    supports_color = (sys.stderr.isatty() and (
-                                        env_term.startswith('vt') or
-                                        env_term.startswith('linux') or
-                                        'xterm' in env_term or
-                                        'color' in env_term
-                                        )
-                                     )
+                    status = reply.get('status', [None])[0]
 
                     # TODO: Test when you don't support color.
                     if not supports_color:
-                        path = os.path.basename(file_path)
                         return (path, path)
 
                     if status == "up to date":
@@ -932,42 +1173,45 @@ options:
                     else:
                         init, cleanup = '', ''
 
-                    path = os.path.basename(file_path)
                     return (path, "%s%s%s" % (init, path, cleanup))
 
-                # Prints a directory.
-                def print_directory(name):
+                # Gets string representations for entries, pipelining the status lookups.
+                def paths_to_strings(names, file_paths, exists=None):
                     clean_paths = []
                     formatted_paths = []
-                    for subname in sorted(os.listdir(name), key=methodcaller('lower')):
-                        if type(subname) != str:
+                    replies = icon_overlay_file_statuses(dc, file_paths, options.pipeline, exists)
+                    for name, reply in zip(names, replies):
+                        if isinstance(reply, UnicodeError):
                             continue
 
-                        if not options.all and subname[0] == '.':
-                            continue
+                        clean, formatted = path_to_string(name, reply)
+                        clean_paths.append(clean)
+                        formatted_paths.append(formatted)
 
-                        try:
-                            clean, formatted = path_to_string(os.path.abspath(os.path.join(name, subname)))
-                            clean_paths.append(clean)
-                            formatted_paths.append(formatted)
-                        except (UnicodeEncodeError, UnicodeDecodeError):
-                            continue
+                    return (clean_paths, formatted_paths)
+
+                # Prints a directory, reusing what scandir already knows about
+                # each entry instead of building and stat'ing its path again.
+                def print_directory(name):
+                    with os.scandir(os.path.abspath(name)) as it:
+                        entries = [entry for entry in it if options.all or entry.name[0] != '.']
+
+                    entries.sort(key=lambda entry: entry.name.lower())
+
+                    # Only a dangling symlink can be listed and not exist
+                    exists = [not entry.is_symlink() or os.path.exists(entry.path) for entry in entries]
 
-                    columnize(clean_paths, formatted_paths)
+                    columnize(*paths_to_strings([entry.name for entry in entries],
+                                                [entry.path for entry in entries],
+                                                exists))
 
                 try:
                     if len(dirs) == 1 and len(nondirs) == 0:
                         print_directory(dirs[0])
                     else:
-                        nondir_formatted_paths = []
-                        nondir_clean_paths = []
-                        for name in nondirs:
-                            try:
-                                clean, formatted = path_to_string(os.path.abspath(name))
-                                nondir_clean_paths.append(clean)
-                                nondir_formatted_paths.append(formatted)
-                            except (UnicodeEncodeError, UnicodeDecodeError):
-                                continue
+                        nondir_paths = [os.path.abspath(name) for name in nondirs]
+                        nondir_clean_paths, nondir_formatted_paths = paths_to_strings([os.path.basename(path) for path in nondir_paths],
+                                                                                      nondir_paths)
 
                         if nondir_clean_paths:
                             columnize(nondir_clean_paths, nondir_formatted_paths)
@@ -994,24 +1238,26 @@ options:
                     console_print("<empty>")
                     return
                 indent = max(len(st)+1 for st in args)
+                files = []
                 for file in args:
 
                     try:
                         if type(file) is not str:
                             file = file.decode(enc)
-                        fp = os.path.abspath(file)
+                        files.append((file, os.path.abspath(file)))
                     except (UnicodeEncodeError, UnicodeDecodeError):
                         continue
-                    if not os.path.exists(fp):
+
+                replies = icon_overlay_file_statuses(dc, [fp for _, fp in files], options.pipeline)
+                for (file, fp), reply in zip(files, replies):
+                    if reply is None:
                         console_print("%-*s %s" % \
                                           (indent, file+':', "File doesn't exist"))
-                        continue
-
-                    try:
-                        status = dc.icon_overlay_file_status(path=fp).get('status', ['unknown'])[0]
+                    elif isinstance(reply, DropboxCommand.CommandError):
+                        console_print("%-*s %s" % (indent, file+':', reply))
+                    elif not isinstance(reply, UnicodeError):
+                        status = reply.get('status', ['unknown'])[0]
                         console_print("%-*s %s" % (indent, file+':', status))
-                    except DropboxCommand.CommandError as e:
-                        console_print("%-*s %s" % (indent, file+':', e))
     except DropboxCommand.CouldntConnectError:
         console_print("Dropbox isn't running!")
 
@@ -1025,6 +1271,203 @@ This is an alias for filestatus -l
     """
     return filestatus(["-l"] + args)
 
+SYNC_STATUSES = ["up to date", "syncing", "unsyncable", "selsync"]
+
+@command
+@requires_dropbox_running
+def tree(args):
+    """summarize sync status of a directory tree
+dropbox tree [-d N] [-a] [-p N] [-c N] [DIRECTORY]
+
+Walks DIRECTORY (default: the current directory) and prints, for every
+directory that isn't up to date, how many entries below it are up to
+date, syncing, unsyncable, selsync or something else. Directories the
+daemon reports as up to date are not walked into.
+
+options:
+  -d --depth N        Walk at most N levels below DIRECTORY
+  -a --all            Do not ignore entries starting with "."
+  -p --pipeline N     Keep up to N status requests in flight on each connection (default 64)
+  -c --connections N  Spread status requests over up to N connections (default 4)
+    """
+    oparser = optparse.OptionParser()
+    oparser.add_option("-d", "--depth", type="int", dest="depth", default=None)
+    oparser.add_option("-a", "--all", action="store_true", dest="all")
+    oparser.add_option("-p", "--pipeline", type="int", dest="pipeline", default=PIPELINE_DEPTH)
+    oparser.add_option("-c", "--connections", type="int", dest="connections", default=POOL_SIZE)
+    (options, args) = oparser.parse_args(args)
+    check_at_least_one(oparser, options, "pipeline", "connections")
+
+    if len(args) > 1:
+        console_print(tree.__doc__, linebreak=False)
+        return
+
+    root = args[0] if args else "."
+    if not os.path.isdir(root):
+        console_print("%s: Not a directory" % root)
+        return
+
+    def reply_status(reply):
+        if isinstance(reply, dict):
+            return reply.get('status', ['unknown'])[0]
+        return 'unknown'
+
+    try:
+        with closing(DropboxCommandPool(options.connections)) as dc:
+            try:
+                root_reply = next(dc.send_commands("icon_overlay_file_status", [{'path': os.path.abspath(root)}]))
+                if reply_status(root_reply) == "up to date":
+                    console_print("%s: up to date" % root)
+                    return
+
+                # Walk a level at a time, so each round's lookups cover many
+                # directories and keep every connection busy
+                order = [root]
+                parents = {root: None}
+                depths = {root: 0}
+                counts = {root: dict((status, 0) for status in SYNC_STATUSES + ["other"])}
+                level = [root]
+
+                while level:
+                    entries = []
+                    for directory in level:
+                        try:
+                            with os.scandir(directory) as it:
+                                for entry in it:
+                                    if not options.all and entry.name.startswith('.'):
+                                        continue
+                                    entries.append((directory, entry.path, entry.is_dir(follow_symlinks=False)))
+                        except OSError:
+                            continue
+
+                    replies = dc.send_commands("icon_overlay_file_status",
+                                               ({'path': os.path.abspath(path)} for _, path, _ in entries),
+                                               options.pipeline)
+                    level = []
+
+                    for (directory, path, is_dir), reply in zip(entries, replies):
+                        status = reply_status(reply)
+                        counts[directory][status if status in SYNC_STATUSES else "other"] += 1
+
+                        if (is_dir and status != "up to date" and
+                            (options.depth is None or depths[directory] < options.depth)):
+                            order.append(path)
+                            parents[path] = directory
+                            depths[path] = depths[directory] + 1
+                            counts[path] = dict((status, 0) for status in SYNC_STATUSES + ["other"])
+                            level.append(path)
+
+                # Children were discovered after their parents, so adding up
+                # in reverse gives every directory its whole subtree
+                for path in reversed(order):
+                    if parents[path] is not None:
+                        for status, count in counts[path].items():
+                            counts[parents[path]][status] += count
+
+                children = dict((path, []) for path in order)
+                for path in order[1:]:
+                    children[parents[path]].append(path)
+
+                columns = SYNC_STATUSES + ["other"]
+                console_print("  ".join(columns) + "  path")
+
+                def print_directory(path):
+                    console_print("  ".join(str(counts[path][status]).rjust(len(status)) for status in columns) +
+                                  "  " + path)
+                    for child in sorted(children[path], key=methodcaller('lower')):
+                        print_directory(child)
+
+                print_directory(root)
+            except DropboxCommand.EOFError:
+                console_print("Dropbox daemon stopped.")
+            except DropboxCommand.BadConnectionError:
+                console_print("Dropbox isn't responding!")
+    except DropboxCommand.CouldntConnectError:
+        console_print("Dropbox isn't running!")
+
+@command
+@requires_dropbox_running
+def find(args):
+    """list files with a given sync status
+dropbox find [PATH] [--status STATUS[,STATUS]...] [--max N] [-print0] [-p N]
+
+Walks PATH (default: the current directory) and prints each file or
+directory below it whose sync status is one of STATUS, as soon as it is
+found. Output is in walk order, not sorted.
+
+options:
+  -s --status LIST   Comma separated statuses to match, e.g. unsyncable,syncing (default: unsyncable,syncing)
+  -m --max N         Stop after N matches
+  -print0            End each path with a NUL instead of a newline, for xargs -0
+  -p --pipeline N    Keep up to N status requests in flight (default 64)
+    """
+    # optparse can't take find's single dash long option
+    print0 = "-print0" in args
+    args = [arg for arg in args if arg != "-print0"]
+
+    oparser = optparse.OptionParser()
+    oparser.add_option("-s", "--status", dest="status", default="unsyncable,syncing")
+    oparser.add_option("-m", "--max", type="int", dest="max", default=None)
+    oparser.add_option("-p", "--pipeline", type="int", dest="pipeline", default=PIPELINE_DEPTH)
+    (options, args) = oparser.parse_args(args)
+    check_at_least_one(oparser, options, "pipeline")
+
+    if len(args) > 1:
+        console_print(find.__doc__, linebreak=False)
+        return
+
+    root = args[0] if args else "."
+    if not os.path.isdir(root):
+        console_print("%s: Not a directory" % root)
+        return
+
+    wanted = set(status.strip() for status in options.status.split(","))
+    terminator = "\0" if print0 else os.linesep
+
+    # Paths waiting for their reply, in the order their requests were sent
+    pending = collections.deque()
+
+    # Depth first walk driven by a queue of (shown path, absolute path)
+    # directories, feeding requests to the pipeline as entries turn up
+    def requests():
+        directories = [(root, os.path.abspath(root))]
+        while directories:
+            shown, absolute = directories.pop()
+            try:
+                with os.scandir(absolute) as it:
+                    for entry in it:
+                        entry_shown = os.path.join(shown, entry.name)
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                directories.append((entry_shown, entry.path))
+                        except OSError:
+                            pass
+                        pending.append(entry_shown)
+                        yield {'path': entry.path}
+            except OSError:
+                continue
+
+    matches = 0
+    try:
+        with closing(DropboxCommand()) as dc:
+            try:
+                for reply in dc.send_commands("icon_overlay_file_status", requests(), options.pipeline):
+                    shown = pending.popleft()
+                    if not isinstance(reply, dict) or reply.get('status', [None])[0] not in wanted:
+                        continue
+
+                    console_print(shown + terminator, linebreak=False)
+                    console_flush()
+                    matches += 1
+                    if options.max is not None and matches >= options.max:
+                        break
+            except DropboxCommand.EOFError:
+                console_print("Dropbox daemon stopped.")
+            except DropboxCommand.BadConnectionError:
+                console_print("Dropbox isn't responding!")
+    except DropboxCommand.CouldntConnectError:
+        console_print("Dropbox isn't running!")
+
 @command
 @requires_dropbox_running
 def puburl(args):
@@ -1329,7 +1772,14 @@ Any specified path must be within Dropbox.
         try:
             with closing(DropboxCommand()) as dc:
                 try:
-                    lines = [relpath(path) for path in dc.get_ignore_set()['ignore_set']]
+                    lines = []
+                    found = False
+                    for key, paths in dc.stream_command('get_ignore_set', {}):
+                        if key == 'ignore_set':
+                            found = True
+                            lines.extend(relpath(path) for path in paths)
+                    if not found:
+                        raise KeyError('ignore_set')
                     lines.sort()
                     if len(lines) == 0:
                         console_print('No directories are being ignored.')
@@ -1409,6 +1859,169 @@ Any specified path must be within Dropbox.
         console_print(exclude.__doc__, linebreak=False)
         return
 
+@command
+@requires_dropbox_running
+def batch(args):
+    """run commands read from standard input over one connection
+dropbox batch [-p N]
+
+Reads one command per line from standard input and prints one JSON
+result per line, in input order, as each one completes. A line is either
+the command as it would follow "dropbox" on the command line, e.g.
+
+  sharelink Photos/cat.jpg
+
+or a JSON object, whose "id" (if any) is copied to its result:
+
+  {"id": 7, "command": "filestatus", "args": ["Photos/cat.jpg"]}
+
+Each result has the input "line" number, "command", "args" and "ok". When
+"ok" is true the reply is in "result", otherwise the reason is in "error";
+a failed command doesn't stop the batch.
+
+commands:
+  filestatus PATH                   {"status": STATUS}
+  sharelink PATH                    {"link": URL}
+  puburl PATH                       {"link": URL}
+  status                            {"status": [LINE, ...]}
+  exclude [list]                    {"excluded": [PATH, ...]}
+  exclude add DIRECTORY...          {"excluded": [PATH, ...]}
+  exclude remove DIRECTORY...       {"removed": [PATH, ...]}
+
+options:
+  -p --pipeline N    Keep up to N requests in flight (default 64). Use 1 when
+                     waiting for each result before writing the next command
+    """
+    oparser = optparse.OptionParser()
+    oparser.add_option("-p", "--pipeline", type="int", dest="pipeline", default=PIPELINE_DEPTH)
+    (options, args) = oparser.parse_args(args)
+    check_at_least_one(oparser, options, "pipeline")
+
+    if len(args) != 0:
+        console_print(batch.__doc__, linebreak=False)
+        return
+
+    def single_path(command, args):
+        if len(args) != 1:
+            raise ValueError("usage: %s PATH" % command)
+        return os.path.abspath(args[0])
+
+    # Each turns a command's arguments into the daemon request to make and
+    # a function that gets the result from its reply
+    def filestatus_request(args):
+        path = single_path("filestatus", args)
+        if not os.path.exists(path):
+            raise ValueError("File doesn't exist!")
+        return ('icon_overlay_file_status', {'path': path},
+                lambda reply: {'status': reply['status'][0]})
+
+    def sharelink_request(args):
+        return ('get_shared_link', {'path': single_path("sharelink", args)},
+                lambda reply: {'link': reply['link'][0]})
+
+    def puburl_request(args):
+        return ('get_public_link', {'path': single_path("puburl", args)},
+                lambda reply: {'link': reply['link'][0]})
+
+    def status_request(args):
+        if len(args) != 0:
+            raise ValueError("usage: status")
+        return ('get_dropbox_status', {},
+                lambda reply: {'status': reply['status']})
+
+    def exclude_request(args):
+        if len(args) == 0 or args == ["list"]:
+            return ('get_ignore_set', {},
+                    lambda reply: {'excluded': sorted(reply['ignore_set'])})
+        if len(args) >= 2 and args[0] == "add":
+            return ('ignore_set_add', {'paths': [os.path.abspath(path) for path in args[1:]]},
+                    lambda reply: {'excluded': reply['ignored']})
+        if len(args) >= 2 and args[0] == "remove":
+            return ('ignore_set_remove', {'paths': [os.path.abspath(path) for path in args[1:]]},
+                    lambda reply: {'removed': reply['removed']})
+        raise ValueError("usage: exclude [list] | exclude add|remove DIRECTORY...")
+
+    requesters = {
+        'filestatus': filestatus_request,
+        'stat': filestatus_request,
+        'sharelink': sharelink_request,
+        'puburl': puburl_request,
+        'status': status_request,
+        'exclude': exclude_request,
+    }
+
+    # (result, function getting it from the reply) for every line read,
+    # in the order their requests (or errors) went into the pipeline
+    pending = collections.deque()
+
+    def requests():
+        for number, line in enumerate(sys.stdin, 1):
+            line = line.strip()
+            if not line:
+                continue
+
+            result = {'line': number}
+            try:
+                if line.startswith('{'):
+                    item = json.loads(line)
+                    if 'id' in item:
+                        result['id'] = item['id']
+                    argv = [item.get('command')] + item.get('args', [])
+                else:
+                    argv = shlex.split(line)
+
+                if not argv or not all(isinstance(arg, str) for arg in argv):
+                    raise ValueError('expected a command, or {"command": NAME, "args": [ARG, ...]}')
+
+                result['command'], result['args'] = argv[0], argv[1:]
+                if argv[0] not in requesters:
+                    raise ValueError("unknown command: %s" % argv[0])
+
+                name, daemon_args, get_result = requesters[argv[0]](argv[1:])
+            except (ValueError, TypeError, AttributeError) as e:
+                pending.append((result, None))
+                yield ValueError(str(e))
+                continue
+
+            pending.append((result, get_result))
+            yield (name, daemon_args)
+
+    try:
+        # No timeout, as exclude add and remove can take a while
+        with closing(DropboxCommand(timeout=None)) as dc:
+            try:
+                for reply in dc.send_requests(requests(), options.pipeline):
+                    result, get_result = pending.popleft()
+
+                    if isinstance(reply, UnicodeEncodeError):
+                        error = "Arguments can't be encoded"
+                    elif isinstance(reply, Exception):
+                        error = str(reply)
+                    else:
+                        try:
+                            value = get_result(reply)
+                            error = None
+                        except (KeyError, IndexError):
+                            error = "daemon isn't responding"
+
+                    result['ok'] = error is None
+                    if error is None:
+                        result['result'] = value
+                    else:
+                        result['error'] = error
+
+                    console_print(json.dumps(result))
+                    console_flush()
+            except DropboxCommand.BadConnectionError:
+                console_print("Dropbox isn't responding!", f=sys.stderr)
+                return 1
+            except DropboxCommand.EOFError:
+                console_print("Dropbox daemon stopped.", f=sys.stderr)
+                return 1
+    except DropboxCommand.CouldntConnectError:
+        console_print("Dropbox isn't running!", f=sys.stderr)
+        return 1
+
 @command
 def start(argv):
     """start dropboxd
@@ -1584,6 +2197,8 @@ def main(argv):
     elif argv[i] in aliases:
         result = aliases[argv[i]](argv[i+1:])
 
+    stop_command_ticker()
+
     # flush, in case output is rerouted to a file.
     console_flush()
 
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+#
+# dropbox_bench
+# Times dropbox.py's ls, filestatus and exclude against fake_dropboxd.py,
+# over directories (and ignore sets) of 10 to 100000 entries.
+#
+# Everything happens under a temporary HOME, so it never touches a real
+# Dropbox. Each run is a fresh dropbox.py process, so start-up is included,
+# which is what a user sees.
+#
+from __future__ import with_statement
+
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SHELL_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Output that means the run didn't really talk to the daemon
+FAILURE_MARKERS = ["Dropbox isn't running!", "Dropbox isn't responding!", "Dropbox daemon stopped."]
+
+def start_daemon(daemon_path, home, latency, ignore):
+    socket_path = os.path.join(home, ".dropbox", "command_socket")
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    daemon = subprocess.Popen([sys.executable, daemon_path, "--home", home,
+                               "--latency", str(latency), "--ignore", str(ignore),
+                               "--status", "*7=syncing", "--status", "*99=unsyncable"])
+
+    for _ in range(100):
+        if os.path.exists(socket_path):
+            return daemon
+        time.sleep(0.05)
+
+    daemon.kill()
+    raise RuntimeError("fake daemon didn't start")
+
+def stop_daemon(daemon):
+    daemon.terminate()
+    daemon.wait()
+
+def make_entries(directory, count):
+    os.makedirs(directory)
+    for i in range(count):
+        open(os.path.join(directory, "entry-%06d" % i), "w").close()
+
+# Best wall clock time of `repeat` runs, or None if any run failed
+def time_command(argv, cwd, home, repeat):
+    env = dict(os.environ, HOME=home)
+    best = None
+
+    for _ in range(repeat):
+        started = time.time()
+        result = subprocess.run(argv, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True)
+        elapsed = time.time() - started
+
+        if result.returncode != 0 or any(marker in result.stdout for marker in FAILURE_MARKERS):
+            return None
+
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+def main(argv):
+    oparser = optparse.OptionParser(usage="""%prog [options]
+
+Times dropbox.py ls, filestatus and exclude against fake_dropboxd.py.""")
+    oparser.add_option("--sizes", dest="sizes", default="10,100,1000,10000,100000",
+                       help="comma separated entry counts (default: 10,100,1000,10000,100000)")
+    oparser.add_option("--repeat", dest="repeat", type="int", default=3,
+                       help="runs per measurement, the best is reported (default: 3)")
+    oparser.add_option("--latency", dest="latency", type="float", default=0.0001, metavar="SECONDS",
+                       help="fake daemon delay per request (default: 0.0001)")
+    oparser.add_option("--commands", dest="commands", default="ls,filestatus,exclude",
+                       help="comma separated commands to time (default: ls,filestatus,exclude)")
+    oparser.add_option("--dropbox", dest="dropbox", default=os.path.join(SHELL_DIR, "dropbox.py"),
+                       help="dropbox.py to benchmark (default: the one next to this script)")
+    oparser.add_option("--daemon", dest="daemon", default=os.path.join(SHELL_DIR, "fake_dropboxd.py"),
+                       help="fake daemon to run (default: the one next to this script)")
+    (options, args) = oparser.parse_args(argv[1:])
+
+    sizes = [int(size) for size in options.sizes.split(",")]
+    commands = options.commands.split(",")
+    dropbox = [sys.executable, os.path.abspath(options.dropbox)]
+    home = tempfile.mkdtemp(prefix="dropbox-bench.")
+
+    print("%-12s %8s %10s %12s" % ("command", "entries", "best (s)", "entries/s"))
+
+    try:
+        for size in sizes:
+            directory = os.path.join(home, "Dropbox", "entries-%d" % size)
+            make_entries(directory, size)
+
+            daemon = start_daemon(options.daemon, home, options.latency, size)
+
+            try:
+                runs = {
+                    "ls": (dropbox + ["ls", directory], home),
+                    "filestatus": (dropbox + ["filestatus"], directory),
+                    "exclude": (dropbox + ["exclude", "list"], os.path.join(home, "Dropbox")),
+                }
+
+                for name in commands:
+                    run_argv, cwd = runs[name]
+                    best = time_command(run_argv, cwd, home, options.repeat)
+
+                    if best is None:
+                        print("%-12s %8d %10s %12s" % (name, size, "failed", "-"))
+                    else:
+                        print("%-12s %8d %10.3f %12.0f" % (name, size, best, size / best))
+                    sys.stdout.flush()
+            finally:
+                stop_daemon(daemon)
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+#
+# fake_dropboxd
+# Stand-in for the proprietary Dropbox daemon, for trying out and
+# benchmarking dropbox.py without an account.
+#
+# It listens on HOME/.dropbox/command_socket, speaks the same line protocol
+# (command name, "key\tvalue..." lines, "done"; replies start with "ok" or
+# an error and also end with "done") and writes HOME/.dropbox/dropbox.pid,
+# so dropbox.py's is_dropbox_running() check passes. Run it with a
+# throwaway HOME:
+#
+#   HOME=/tmp/fakehome ./fake_dropboxd.py --latency 0.001 --status '*.tmp=syncing' &
+#   HOME=/tmp/fakehome ./dropbox.py ls /tmp/fakehome/Dropbox
+#
+from __future__ import with_statement
+
+import fnmatch
+import json
+import optparse
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+READ_BUFFER_SIZE = 64 * 1024
+
+# Replies for the commands dropbox.py sends, keyed by command name. Values
+# are lists, like the daemon's tab separated values. A reply of
+# {"error": "message"} is sent as an error reply instead.
+DEFAULT_REPLIES = {
+    "get_dropbox_status": {"status": ["Up to date"]},
+    "needs_link": {},
+    "get_public_link": {"link": ["https://www.dropbox.com/s/fake/public"]},
+    "get_shared_link": {"link": ["https://www.dropbox.com/s/fake/shared"]},
+    "set_proxy_settings": {},
+    "set_bandwidth_limits": {},
+    "set_lan_sync": {},
+}
+
+class FakeDropboxDaemon(object):
+    def __init__(self, home, script, status_rules, default_status, ignore_set, latency, command_latency):
+        self.home = home
+        self.script = script
+        self.status_rules = status_rules
+        self.default_status = default_status
+        self.ignore_set = ignore_set
+        self.latency = latency
+        self.command_latency = command_latency
+        self.lock = threading.Lock()
+
+    def socket_path(self):
+        return os.path.join(self.home, ".dropbox", "command_socket")
+
+    def pid_path(self):
+        return os.path.join(self.home, ".dropbox", "dropbox.pid")
+
+    def serve_forever(self):
+        os.makedirs(os.path.join(self.home, ".dropbox"), exist_ok=True)
+        if os.path.exists(self.socket_path()):
+            os.remove(self.socket_path())
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path())
+        server.listen(64)
+
+        with open(self.pid_path(), "w") as f:
+            f.write(str(os.getpid()))
+
+        try:
+            while True:
+                connection, _ = server.accept()
+                thread = threading.Thread(target=self.handle, args=(connection,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            server.close()
+            for path in (self.socket_path(), self.pid_path()):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    # One thread per connection, answering requests strictly in order.
+    # Pipelined requests simply queue up in the socket buffer.
+    def handle(self, connection):
+        r = connection.makefile("r", READ_BUFFER_SIZE)
+        f = connection.makefile("w", READ_BUFFER_SIZE)
+
+        try:
+            while True:
+                name = r.readline()
+                if not name:
+                    return
+                name = name.rstrip("\n")
+
+                args = {}
+                while True:
+                    line = r.readline()
+                    if not line:
+                        return
+                    line = line.rstrip("\n")
+                    if line == "done":
+                        break
+                    key, tab, values = line.partition("\t")
+                    args[key] = values.split("\t") if tab else []
+
+                delay = self.command_latency.get(name, self.latency)
+                if delay:
+                    time.sleep(delay)
+
+                f.write(self.reply(name, args))
+                f.flush()
+        except (socket.error, ValueError):
+            pass
+        finally:
+            connection.close()
+
+    def reply(self, name, args):
+        if name in self.script:
+            return format_reply(self.script[name])
+
+        if name == "icon_overlay_file_status":
+            return self.file_status_reply(args.get("path", [""])[0])
+
+        if name == "get_ignore_set":
+            with self.lock:
+                paths = sorted(self.ignore_set)
+            return format_reply({"ignore_set": paths})
+
+        if name == "ignore_set_add":
+            with self.lock:
+                added = [path for path in args.get("paths", []) if path not in self.ignore_set]
+                self.ignore_set.update(added)
+            return format_reply({"ignored": added})
+
+        if name == "ignore_set_remove":
+            with self.lock:
+                removed = [path for path in args.get("paths", []) if path in self.ignore_set]
+                self.ignore_set.difference_update(removed)
+            return format_reply({"removed": removed})
+
+        if name == "tray_action_hard_exit":
+            # Answer first, then go away like the real thing
+            threading.Timer(0.1, os.kill, (os.getpid(), signal.SIGTERM)).start()
+            return format_reply({})
+
+        if name in DEFAULT_REPLIES:
+            return format_reply(DEFAULT_REPLIES[name])
+
+        return format_error("No command exists by that name")
+
+    def file_status_reply(self, path):
+        status = self.default_status
+        for pattern, rule_status in self.status_rules:
+            if fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(os.path.basename(path), pattern):
+                status = rule_status
+                break
+
+        if not os.path.exists(path):
+            return format_error("Path doesn't exist")
+
+        if status.startswith("error:"):
+            return format_error(status[len("error:"):])
+
+        return format_reply({"status": [status]})
+
+def format_reply(reply):
+    if "error" in reply:
+        return format_error(reply["error"])
+
+    return "ok\n" + "".join("\t".join([key] + list(values)) + "\n" for key, values in reply.items()) + "done\n"
+
+def format_error(message):
+    return "notok\n" + message + "\ndone\n"
+
+def main(argv):
+    oparser = optparse.OptionParser(usage="""%prog [options]
+
+Serves the dropbox command_socket protocol from HOME/.dropbox until killed.""")
+    oparser.add_option("--home", dest="home", default=os.path.expanduser("~"),
+                       help="directory to use as HOME (default: $HOME)")
+    oparser.add_option("--script", dest="script", metavar="FILE",
+                       help="JSON object of fixed replies by command name, e.g. "
+                            "{\"get_dropbox_status\": {\"status\": [\"Syncing 3 files\"]}}, taking precedence over the built-in ones")
+    oparser.add_option("--status", dest="status_rules", action="append", default=[], metavar="PATTERN=STATUS",
+                       help="status for paths matching PATTERN (fnmatch on the full path or the name); "
+                            "STATUS is e.g. syncing, unsyncable, selsync or error:MESSAGE. Repeatable, first match wins")
+    oparser.add_option("--default-status", dest="default_status", default="up to date",
+                       help="status for every other path (default: up to date)")
+    oparser.add_option("--ignore", dest="ignore", type="int", default=0, metavar="N",
+                       help="start with N made up paths under HOME/Dropbox in the ignore set")
+    oparser.add_option("--latency", dest="latency", type="float", default=0.0, metavar="SECONDS",
+                       help="delay before answering each request")
+    oparser.add_option("--command-latency", dest="command_latency", action="append", default=[], metavar="NAME=SECONDS",
+                       help="delay for one command, overriding --latency. Repeatable")
+    (options, args) = oparser.parse_args(argv[1:])
+
+    script = {}
+    if options.script:
+        with open(options.script) as f:
+            script = json.load(f)
+
+    home = os.path.abspath(options.home)
+    status_rules = [tuple(rule.split("=", 1)) for rule in options.status_rules]
+    command_latency = dict((name, float(seconds)) for name, seconds in
+                           (rule.split("=", 1) for rule in options.command_latency))
+    ignore_set = set(os.path.join(home, "Dropbox", "ignored-%d" % i) for i in range(options.ignore))
+
+    daemon = FakeDropboxDaemon(home, script, status_rules, options.default_status,
+                               ignore_set, options.latency, command_latency)
+
+    # Exit through the finally in serve_forever, so the socket and pidfile go
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main(sys.argv)
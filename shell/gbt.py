@@ -3,23 +3,43 @@
 # Git bulk toolkit
 
 from argparse import ArgumentParser
+from array import array
+from collections import Counter
 from pathlib import Path
-from subprocess import Popen, PIPE, check_output
-from threading import Thread
-from time import sleep
+from subprocess import CalledProcessError, DEVNULL, Popen, PIPE, TimeoutExpired, check_output
+from threading import BoundedSemaphore, Thread
+from time import localtime, sleep, time
+from urllib.parse import urlparse
 import configparser
+import hashlib
+import json
 import os
+import random
 import re
 import shutil
+import signal
+import struct
 import sys
 import datetime
 import math
 
+from gbt_prompt import PROMPT_SUMMARY_FORMAT, PROMPT_SUMMARY_MAGIC, PROMPT_SUMMARY_VERSION, get_prompt_summary_path, print_prompt_summary
+
+# Only gbt stats uses numpy and only gbt tui uses curses, see import_numpy and browse_all
+numpy = None
+curses = None
+
 
 class ConfigValue:
 
     DEVELOPMENT_DIR = "home/rahul/"
     REPO_BLACKLIST = "repo_blacklist"
+    MAX_WORKERS = "max_workers"
+    LOCK_TIMEOUT = "lock_timeout"
+    PROMPT_STALE_AFTER = "prompt_stale_after"
+    BACKGROUND_DISK_JOBS = "background_disk_jobs"
+    BACKGROUND_NETWORK_JOBS = "background_network_jobs"
+    BACKGROUND_MAX_LOAD = "background_max_load"
 
 
 class TerminalStyle:
@@ -61,65 +81,167 @@ class LogEntry:
 
 
 class GitStatusWorker:
-    def __init__(self, directory, worker_id, submodule_depth):
+
+    _job_slots = None
+    _disk_slots = None
+    _network_slots = None
+    _max_load = None
+    _lock_timeout = 10.0
+
+    # Jobs that mostly wait on a remote; everything else is bound by local disk
+    _network_jobs = ["_thread_method_fetch", "_thread_method_pull", "_thread_method_clone"]
+
+    def __init__(self, directory, worker_id, submodule_depth, worktree_of=None):
 
         self._directory = directory
         self._worker_id = worker_id
         self._submodule_depth = submodule_depth
+        self._worktree_of = worktree_of
 
         self._work_in_progress = False
         self._repo_id = ""
         self._branch = "unknown"
         self._location = "Up to date"
+        self._ahead = 0
+        self._behind = 0
         self._modified_files = []
         self._untracked_files = []
         self._log_entries = []
+        self._commit_times = array("q")
+        self._commit_authors = array("q")
+        self._commit_author_names = []
+        self._grep_lines = []
+        self._command_output = b""
+        self._command_errors = b""
+        self._command_timed_out = False
+
+        self._cancelled = False
+        self._skipped = False
+        self._process = None
 
         self._error_pulling = 0
         self._error_checking_out = 0
         self._error_getting_status = 0
         self._error_fetching = 0
         self._error_getting_log = 0
+        self._error_grepping = 0
+        self._error_running_command = 0
+        self._error_cloning = 0
+        self._error_maintaining = 0
+        self._error_locked = 0
+        self._maintenance_timings = {}
+
+        self._transfer_phase = ""
+        self._transfer_percent = 0
+        self._transfer_bytes = 0
+        self._transfer_rate = 0
+
+        self._job_started = 0.0
+        self._job_duration = 0.0
 
     def status(self):
 
         if self._work_in_progress is False:
             self._error_getting_status = 0
-            self._work_in_progress = True
-            self._thread = Thread(target=self._thread_method_status)
-            self._thread.start()
+            self._error_locked = 0
+            self._start(self._thread_method_status)
 
     def fetch(self):
 
         if self._work_in_progress is False:
             self._error_fetching = 0
-            self._work_in_progress = True
-            self._thread = Thread(target=self._thread_method_fetch)
-            self._thread.start()
+            self._error_locked = 0
+            self._start(self._thread_method_fetch)
 
     def pull(self):
 
         if self._work_in_progress is False:
             self._error_pulling = 0
-            self._work_in_progress = True
-            self._thread = Thread(target=self._thread_method_pull)
-            self._thread.start()
+            self._error_locked = 0
+            self._start(self._thread_method_pull)
 
-    def checkout(self, branch_name):
+    def checkout(self, branch_name, detach=False):
 
         if self._work_in_progress is False:
             self._error_checking_out = 0
-            self._work_in_progress = True
-            self._thread = Thread(target=self._thread_method_checkout, args=(branch_name,))
-            self._thread.start()
+            self._error_locked = 0
+            self._start(self._thread_method_checkout, branch_name, detach)
 
     def log(self, days_to_log):
 
         if self._work_in_progress is False:
             self._error_getting_log = 0
-            self._work_in_progress = True
-            self._thread = Thread(target=self._thread_method_log, args=(days_to_log,))
-            self._thread.start()
+            self._error_locked = 0
+            self._start(self._thread_method_log, days_to_log)
+
+    def stats(self, days_to_count):
+
+        if self._work_in_progress is False:
+            self._error_getting_log = 0
+            self._error_locked = 0
+            self._start(self._thread_method_stats, days_to_count)
+
+    def grep(self, pattern, pathspecs):
+
+        if self._work_in_progress is False:
+            self._error_grepping = 0
+            self._grep_lines = []
+            self._start(self._thread_method_grep, pattern, pathspecs)
+
+    def run_command(self, command, timeout=None):
+
+        if self._work_in_progress is False:
+            self._error_running_command = 0
+            self._command_output = b""
+            self._command_errors = b""
+            self._command_timed_out = False
+            self._start(self._thread_method_command, command, timeout)
+
+    def clone(self, url, clone_options, host_slots):
+
+        if self._work_in_progress is False:
+            self._error_cloning = 0
+            self._command_errors = b""
+            self._start(self._thread_method_clone, url, clone_options, host_slots)
+
+    def maintain(self, command_prefix):
+
+        if self._work_in_progress is False:
+            self._error_maintaining = 0
+            self._maintenance_timings = {}
+            self._command_errors = b""
+            self._start(self._thread_method_maintain, command_prefix)
+
+    def cancel(self):
+
+        if self._work_in_progress is False:
+            return
+
+        self._cancelled = True
+
+        process = self._process
+        if process is not None and process.poll() is None:
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    @classmethod
+    def limit_concurrency(cls, max_jobs):
+
+        cls._job_slots = BoundedSemaphore(max_jobs)
+
+    @classmethod
+    def throttle(cls, disk_jobs, network_jobs, max_load):
+
+        cls._disk_slots = BoundedSemaphore(disk_jobs)
+        cls._network_slots = BoundedSemaphore(network_jobs)
+        cls._max_load = max_load
+
+    @classmethod
+    def set_lock_timeout(cls, lock_timeout):
+
+        cls._lock_timeout = lock_timeout
 
     def directory(self):
 
@@ -127,7 +249,16 @@ class GitStatusWorker:
 
     def is_submodule(self):
 
-        return self._submodule_depth > 0
+        # Worktrees are listed under their repository too, but aren't submodules
+        return self._submodule_depth > 0 and not self.is_worktree()
+
+    def is_worktree(self):
+
+        return self._worktree_of is not None
+
+    def worktree_of(self):
+
+        return self._worktree_of
 
     def short_name(self):
 
@@ -135,7 +266,7 @@ class GitStatusWorker:
 
     def display_name(self):
 
-        if self.is_submodule():
+        if self._submodule_depth > 0:
             return (" " * (self._submodule_depth - 1)) + "↳ " + self.short_name()
         else:
             return self.short_name()
@@ -152,6 +283,14 @@ class GitStatusWorker:
 
         return self._location[0].upper() + self._location[1:]
 
+    def ahead(self):
+
+        return self._ahead
+
+    def behind(self):
+
+        return self._behind
+
     def modified_files(self):
 
         return self._modified_files
@@ -164,10 +303,62 @@ class GitStatusWorker:
 
         return self._log_entries
 
+    def commit_times(self):
+
+        return self._commit_times
+
+    def commit_authors(self):
+
+        return self._commit_authors
+
+    def commit_author_names(self):
+
+        return self._commit_author_names
+
+    def grep_lines(self):
+
+        return self._grep_lines
+
+    def command_output(self):
+
+        return self._command_output
+
+    def command_errors(self):
+
+        return self._command_errors
+
+    def command_timed_out(self):
+
+        return self._command_timed_out
+
+    def cancelled(self):
+
+        return self._skipped or (self._cancelled and self._error_running_command < 0)
+
     def work_in_progress(self):
 
         return self._work_in_progress
 
+    def job_duration(self):
+
+        return self._job_duration
+
+    def transfer_phase(self):
+
+        return self._transfer_phase
+
+    def transfer_percent(self):
+
+        return self._transfer_percent
+
+    def transfer_bytes(self):
+
+        return self._transfer_bytes
+
+    def transfer_rate(self):
+
+        return self._transfer_rate
+
     def error_pulling(self):
 
         return self._error_pulling
@@ -188,39 +379,200 @@ class GitStatusWorker:
 
         return self._error_getting_log
 
+    def error_grepping(self):
+
+        return self._error_grepping
+
+    def error_running_command(self):
+
+        return self._error_running_command
+
+    def error_cloning(self):
+
+        return self._error_cloning
+
+    def error_maintaining(self):
+
+        return self._error_maintaining
+
+    def maintenance_timings(self):
+
+        return self._maintenance_timings
+
+    def error_locked(self):
+
+        return self._error_locked
+
     def error_occurred(self):
 
-        return self.error_pulling() != 0 or self.error_checking_out() != 0 or self.error_getting_status() != 0 or self.error_fetching() != 0 or self.error_getting_log() != 0
+        return self.error_pulling() != 0 or self.error_checking_out() != 0 or self.error_getting_status() != 0 or self.error_fetching() != 0 or self.error_getting_log() != 0 or self.error_grepping() != 0 or self.error_running_command() != 0 or self.error_cloning() != 0 or self.error_maintaining() != 0 or self.error_locked() != 0
 
     def join(self):
 
         self._thread.join()
 
+    def _start(self, target, *args):
+
+        self._work_in_progress = True
+        self._cancelled = False
+        self._skipped = False
+        self._job_duration = 0.0
+        self._thread = Thread(target=self._run_job, args=(target,) + args)
+        self._thread.start()
+
+    def _run_job(self, target, *args):
+
+        if target.__name__ in self._network_jobs:
+            kind_slots = self._network_slots
+        else:
+            kind_slots = self._disk_slots
+
+        if self._job_slots is not None:
+            self._job_slots.acquire()
+
+        if kind_slots is not None:
+            kind_slots.acquire()
+
+        try:
+            self._wait_for_load()
+
+            if self._cancelled is False:
+                self._job_started = time()
+                target(*args)
+                self._job_duration = time() - self._job_started
+            else:
+                self._skipped = True
+        finally:
+            if kind_slots is not None:
+                kind_slots.release()
+
+            if self._job_slots is not None:
+                self._job_slots.release()
+
+            # Never leave the worker marked busy, or anything waiting on it spins forever
+            self._work_in_progress = False
+
+    def _wait_for_load(self):
+
+        # Jobs already running carry on, but nothing new starts while the
+        # machine is busy with something else
+        while self._max_load is not None and self._cancelled is False and os.getloadavg()[0] > self._max_load:
+            sleep(1.0)
+
+    def _run_write_command(self, command, track_progress=False):
+
+        deadline = time() + self._lock_timeout
+        delay = 0.1
+
+        while True:
+            if track_progress:
+                errors = self._run_with_progress(command[:2] + ["--progress"] + command[2:])
+                returncode = self._process.returncode
+                self._process = None
+            else:
+                process = Popen(command, stdout=PIPE, stderr=PIPE, cwd=self._directory)
+                _, errors = process.communicate()
+                returncode = process.returncode
+
+            if returncode == 0 or not is_lock_error(errors):
+                return returncode
+
+            if time() + delay > deadline:
+                self._error_locked = returncode
+                return 0
+
+            # Back off with jitter, so workers racing for the same lock spread out
+            sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, 2.0)
+
+    def _run_with_progress(self, command):
+
+        self._process = Popen(command, stdout=DEVNULL, stderr=PIPE, cwd=self._directory)
+        errors = bytearray()
+        pending = b""
+
+        # git redraws its progress lines with \r, so parse each chunk as it
+        # arrives rather than waiting for newlines
+        while True:
+            chunk = os.read(self._process.stderr.fileno(), 4096)
+            if not chunk:
+                break
+
+            errors += chunk
+            lines = re.split(b"[\r\n]", pending + chunk)
+            pending = lines.pop()
+
+            for line in lines:
+                self._process_progress_line(line.decode("UTF-8", "replace"))
+
+        self._process.wait()
+        self._process.stderr.close()
+        self._transfer_phase = ""
+        self._transfer_rate = 0
+
+        return bytes(errors)
+
+    def _process_progress_line(self, line):
+
+        result = re.search("(?:Receiving|Unpacking) objects: +(\\d+)%(?:.*?, ([\\d.]+) (bytes|[KMG]iB))?(?:.*?\\| ([\\d.]+) (bytes|[KMG]iB)/s)?", line)
+        if result:
+            self._transfer_phase = "receiving"
+            self._transfer_percent = int(result.group(1))
+
+            if result.group(2):
+                self._transfer_bytes = parse_bytes(result.group(2), result.group(3))
+
+            if result.group(4):
+                self._transfer_rate = parse_bytes(result.group(4), result.group(5))
+
+            return
+
+        result = re.search("Resolving deltas: +(\\d+)%", line)
+        if result:
+            self._transfer_phase = "resolving"
+            self._transfer_percent = int(result.group(1))
+            self._transfer_rate = 0
+
     def _thread_method_status(self):
 
+        # Workers are reused, so nothing from the last status run may carry over
+        self._location = "Up to date"
+        self._ahead = 0
+        self._behind = 0
         self._modified_files.clear()
         self._untracked_files.clear()
 
         try:
-            output = check_output(["git", "rev-list", "HEAD"], cwd=self._directory, stderr=FNULL)
+            output = check_output(["git", "--no-optional-locks", "rev-list", "HEAD"], cwd=self._directory, stderr=DEVNULL)
             output = output.decode("UTF-8")
             self._repo_id = output.split("\n")[-2]
         except:
             pass
 
-        output = check_output(["git", "status", "-sb"], cwd=self._directory)
+        try:
+            output = check_output(["git", "--no-optional-locks", "status", "-sb"], cwd=self._directory, stderr=PIPE)
+        except CalledProcessError as error:
+            if is_lock_error(error.stderr):
+                self._error_locked = error.returncode
+            else:
+                self._error_getting_status = error.returncode
+            return
+        except OSError:
+            self._error_getting_status = 1
+            return
+
         output = output.decode("UTF-8")
 
         self._process_status_output(output)
 
-        self._work_in_progress = False
-
     def _thread_method_log(self, days_to_log):
 
+        self._log_entries.clear()
+
         try:
             delimiter = "~|~"
             since_date = (datetime.date.today() - datetime.timedelta(days=days_to_log)).strftime("%Y-%m-%d")
-            output = check_output(["git", "log", "--pretty=format:%ct" + delimiter + "%cr" + delimiter + "%cn" + 
+            output = check_output(["git", "--no-optional-locks", "log", "--pretty=format:%ct" + delimiter + "%cr" + delimiter + "%cn" + 
 
 
 delimiter + "%s %d", "--since=" + since_date, "--branches"], cwd=self._directory)
@@ -240,34 +592,132 @@ delimiter + "%s %d", "--since=" + since_date, "--branches"], cwd=self._directory
         except:
             self._error_getting_log += 1
 
-        self._work_in_progress = False
+    def _thread_method_stats(self, days_to_count):
 
-    def _thread_method_fetch(self):
+        since_date = (datetime.date.today() - datetime.timedelta(days=days_to_count)).strftime("%Y-%m-%d")
 
-        if self.is_submodule() == False:
-            process = Popen(["git", "fetch"], stdout=PIPE, stderr=PIPE, cwd=self._directory)
-            process.communicate()
-            self._error_fetching = process.returncode
+        try:
+            output = check_output(["git", "--no-optional-locks", "log", "--format=%at%n%aN", "--since=" + since_date, "--branches"], cwd=self._directory, stderr=PIPE)
+        except CalledProcessError as error:
+            self._error_getting_log = error.returncode
+            return
+        except OSError:
+            self._error_getting_log = 1
+            return
 
-        self._work_in_progress = False
+        # Timestamps and author names alternate, and the output ends with a
+        # newline, so the last element is always empty
+        lines = output.split(b"\n")
+        author_ids = {}
 
-    def _thread_method_checkout(self, branch_name):
+        self._commit_times = array("q", map(int, lines[0:-1:2]))
+        self._commit_authors = array("q", [author_ids.setdefault(author, len(author_ids)) for author in lines[1::2]])
+        self._commit_author_names = [author.decode("UTF-8", "replace") for author in author_ids]
 
-        if self.is_submodule() == False:
-            process = Popen(["git", "checkout", branch_name], stdout=PIPE, stderr=PIPE, cwd=self._directory)
+    def _thread_method_grep(self, pattern, pathspecs):
+
+        self._process = Popen(["git", "--no-optional-locks", "grep", "-n", "-I", "--no-color", "-e", pattern, "--"] + pathspecs, stdout=PIPE, stderr=PIPE, cwd=self._directory, start_new_session=True)
+
+        for line in self._process.stdout:
+            self._grep_lines.append(self.short_name() + "/" + line.decode("UTF-8", "replace").rstrip("\n"))
+
+        self._process.communicate()
+
+        # git grep exits with 1 when nothing matched, which is not an error
+        if self._process.returncode > 1 and self._cancelled is False:
+            self._error_grepping = self._process.returncode
+
+        self._process = None
+
+    def _thread_method_command(self, command, timeout):
+
+        try:
+            self._process = Popen(command, stdout=PIPE, stderr=PIPE, cwd=self._directory, start_new_session=True)
+        except OSError as error:
+            self._command_errors = (str(error) + "\n").encode("UTF-8")
+            self._error_running_command = 127
+            return
+
+        try:
+            self._command_output, self._command_errors = self._process.communicate(timeout=timeout)
+        except TimeoutExpired:
+            # Kill the whole process group, otherwise grandchildren holding
+            # the pipes open keep communicate() waiting
+            try:
+                os.killpg(self._process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            self._command_output, self._command_errors = self._process.communicate()
+            self._command_timed_out = True
+
+        self._error_running_command = self._process.returncode
+        self._process = None
+
+    def _thread_method_clone(self, url, clone_options, host_slots):
+
+        with host_slots:
+            os.makedirs(os.path.dirname(os.path.normpath(self._directory)), exist_ok=True)
+            process = Popen(["git", "clone", "--quiet"] + clone_options + ["--", url, self._directory], stdout=PIPE, stderr=PIPE)
+            _, self._command_errors = process.communicate()
+            self._error_cloning = process.returncode
+
+    def _thread_method_maintain(self, command_prefix):
+
+        benchmarks = {
+            "status": ["git", "--no-optional-locks", "status", "--porcelain"],
+            "log": ["git", "--no-optional-locks", "log", "--oneline", "-n", "1000"],
+        }
+
+        for name, command in benchmarks.items():
+            self._maintenance_timings[name] = [self._time_command(command), None]
+
+        for command in [
+            ["git", "commit-graph", "write", "--reachable"],
+            ["git", "repack", "-d", "-l", "-q", "--geometric=2"],
+            ["git", "prune-packed"],
+            ["git", "prune", "--expire=2.weeks.ago"],
+            ["git", "pack-refs", "--all"],
+        ]:
+            process = Popen(command_prefix + command, stdout=PIPE, stderr=PIPE, cwd=self._directory)
+            _, self._command_errors = process.communicate()
+
+            if process.returncode != 0:
+                self._error_maintaining = process.returncode
+                break
+
+        for name, command in benchmarks.items():
+            self._maintenance_timings[name][1] = self._time_command(command)
+
+    def _time_command(self, command, runs=3):
+
+        best = None
+
+        for _ in range(runs):
+            started = time()
+            process = Popen(command, stdout=PIPE, stderr=PIPE, cwd=self._directory)
             process.communicate()
-            self._error_checking_out = process.returncode
+            elapsed = time() - started
 
-        self._work_in_progress = False
+            if best is None or elapsed < best:
+                best = elapsed
 
-    def _thread_method_pull(self):
+        return best
+
+    def _thread_method_fetch(self):
+
+        # A worktree's remote refs are its repository's, which fetches them already
+        if self.is_submodule() == False and self.is_worktree() == False:
+            self._error_fetching = self._run_write_command(["git", "fetch"], track_progress=True)
+
+    def _thread_method_checkout(self, branch_name, detach):
 
         if self.is_submodule() == False:
-            process = Popen(["git", "pull", "--recurse-submodules"], stdout=PIPE, stderr=PIPE, cwd=self._directory)
-            process.communicate()
-            self._error_pulling = process.returncode
+            self._error_checking_out = self._run_write_command(["git", "checkout"] + (["--detach"] if detach else []) + [branch_name])
 
-        self._work_in_progress = False
+    def _thread_method_pull(self):
+
+        if self.is_submodule() == False:
+            self._error_pulling = self._run_write_command(["git", "pull", "--recurse-submodules"], track_progress=True)
 
     def _process_status_output(self, output):
 
@@ -285,6 +735,12 @@ delimiter + "%s %d", "--since=" + since_date, "--branches"], cwd=self._directory
                 if result:
                     self._location = result.group(1)
 
+                    result = re.search("ahead (\\d+)", self._location)
+                    self._ahead = int(result.group(1)) if result else 0
+
+                    result = re.search("behind (\\d+)", self._location)
+                    self._behind = int(result.group(1)) if result else 0
+
                 if "No commits yet on" in self._branch:
                     self._branch = self._branch.split()[-1]
                     self._location = "Empty"
@@ -311,10 +767,49 @@ def get_repositories(parent_directory, git_workers, repo_blacklist, submodule_de
         "/home/rahul/Documents/personal/wikiNotes/",
         "/home/rahul/Documents/personal/texTemplates/",
     ]
-    for path in allRepos:
+    for path in sorted(allRepos):
         abs_path = os.path.join(parent_directory, path)
         git_config_path = os.path.join(abs_path, ".git")
         git_workers.append(GitStatusWorker(abs_path, len(git_workers), submodule_depth))
+        get_nested_repositories(abs_path, git_workers, submodule_depth + 1)
+
+
+def get_nested_repositories(directory, git_workers, submodule_depth):
+
+    # Read linked worktrees and submodules straight from the files git keeps
+    # for them, so discovery doesn't start a git process per repo
+    git_dir = get_git_dir(directory)
+
+    try:
+        worktree_names = sorted(os.listdir(os.path.join(git_dir, "worktrees")))
+    except OSError:
+        worktree_names = []
+
+    for name in worktree_names:
+        try:
+            with open(os.path.join(git_dir, "worktrees", name, "gitdir")) as gitdir_file:
+                worktree_path = os.path.dirname(gitdir_file.read().strip())
+        except OSError:
+            continue
+
+        # Worktrees share refs and objects with the repository they belong to
+        if os.path.isdir(worktree_path):
+            git_workers.append(GitStatusWorker(worktree_path, len(git_workers), submodule_depth, get_common_git_dir(git_dir)))
+
+    try:
+        with open(os.path.join(directory, ".gitmodules")) as gitmodules_file:
+            submodule_paths = re.findall("^\\s*path\\s*=\\s*(.+?)\\s*$", gitmodules_file.read(), re.MULTILINE)
+    except OSError:
+        submodule_paths = []
+
+    for path in submodule_paths:
+        submodule_path = os.path.join(directory, path)
+
+        # Uninitialised submodules have no .git yet
+        if os.path.exists(os.path.join(submodule_path, ".git")):
+            git_workers.append(GitStatusWorker(submodule_path, len(git_workers), submodule_depth))
+            get_nested_repositories(submodule_path, git_workers, submodule_depth + 1)
+
 
 def upgrade_existing_config():
 
@@ -375,227 +870,1646 @@ def get_progress_bar_string(progress):
     return progress_bar
 
 
-def display_progress(action_text, action_error_method):
+def get_transfer_string(git_workers):
+
+    transferring = [worker for worker in git_workers if worker.work_in_progress() and worker.transfer_phase() != ""]
+
+    if len(transferring) == 0:
+        return ""
+
+    total_rate = sum(worker.transfer_rate() for worker in transferring)
+    transferring.sort(key=lambda x: (x.transfer_rate(), x.transfer_bytes()), reverse=True)
+
+    top_repos = []
+
+    for worker in transferring[:3]:
+        if worker.transfer_phase() == "resolving":
+            top_repos.append(worker.short_name() + " resolving " + str(worker.transfer_percent()) + "%")
+        else:
+            top_repos.append(worker.short_name() + " " + format_bytes(worker.transfer_bytes()) + " " + str(worker.transfer_percent()) + "%")
+
+    return format_bytes(total_rate) + "/s" + TerminalStyle.DIM + " [ " + ", ".join(top_repos) + " ]" + TerminalStyle.CLEAR
+
+
+def display_progress(git_workers, action_text):
+
+    if len(git_workers) == 0:
+        return
 
     while True:
         workers_busy = sum(1 for worker in git_workers if worker.work_in_progress())
-        
+
         workers_complete = len(git_workers) - workers_busy
         progress_bar = get_progress_bar_string(workers_complete / len(git_workers))
-        progress_line = "\r" + progress_bar + " " + action_text + " (" + str(workers_busy) + " workers still busy) "
+        progress_line = "\r" + progress_bar + " " + action_text + " (" + str(workers_busy) + " workers still busy) " + get_transfer_string(git_workers) + "\033[K"
         sys.stdout.write(progress_line)
+        sys.stdout.flush()
 
         if workers_busy == 0:
-            sys.stdout.write("\r")
+            sys.stdout.write("\r\033[K")
             sys.stdout.flush()
             break
 
+        sleep(0.1)
+
     for worker in git_workers:
         worker.join()
 
 
-def pull_all(git_workers):
+def pull_all(git_workers, show_progress=True):
+
+    fetch_shared_caches(git_workers)
 
     for worker in git_workers:
         worker.pull()
 
-    display_progress("Pulling", "error_pulling")
+    if show_progress:
+        display_progress(git_workers, "Pulling")
 
 
-def checkout_all(git_workers, branch_name):
+def checkout_all(git_workers, branch_name, atomic=False):
+
+    # Resolve the branch and remember HEAD everywhere before touching anything
+    previous_heads = {}
+    missing = []
+    already_on = []
+    candidates = []
+    to_switch = []
+    held_by = {}
 
     for worker in git_workers:
-        worker.checkout(branch_name)
+        if worker.is_submodule():
+            continue
 
-    display_progress("Checking out " + branch_name, "error_checking_out")
+        head = read_head(worker.directory())
+        previous_heads[worker] = head
 
+        if head == ("branch", branch_name):
+            already_on.append(worker)
+        elif has_branch(worker.directory(), branch_name):
+            candidates.append(worker)
+        else:
+            missing.append(worker)
 
-def log_all(git_workers, days_to_log):
+    # A branch can only be checked out in one worktree of a repository, and
+    # checkouts running side by side would each pass git's own check
+    holders = {get_repository_dir(worker.directory()): worker for worker in already_on}
 
-    for worker in git_workers:
-        worker.log(days_to_log)
+    for worker in candidates:
+        repository_dir = get_repository_dir(worker.directory())
 
-    display_progress("Getting logs for last " + str(days_to_log) + " day(s)", "error_getting_log")
+        if repository_dir in holders:
+            held_by[worker] = holders[repository_dir]
+        else:
+            holders[repository_dir] = worker
+            to_switch.append(worker)
 
+    if len(to_switch) > 0:
+        for worker in to_switch:
+            worker.checkout(branch_name)
 
-def fetch_all(git_workers):
+        display_progress(to_switch, "Checking out " + branch_name)
 
-    for worker in git_workers:
-        worker.fetch()
+    failed = [worker for worker in to_switch if worker.error_checking_out() != 0 or worker.error_locked() != 0]
+    switched = [worker for worker in to_switch if worker not in failed]
+    rolled_back = []
 
-    display_progress("Fetching", "error_fetching")
+    # There's nothing to go back to where HEAD couldn't be read
+    to_roll_back = [worker for worker in switched if previous_heads[worker][0] != "unknown"]
 
+    if atomic and len(failed) > 0 and len(to_roll_back) > 0:
+        for worker in to_roll_back:
+            kind, previous = previous_heads[worker]
+            worker.checkout(previous, detach=kind == "detached")
 
-def status_all(git_workers):
+        display_progress(to_roll_back, "Rolling back")
+
+        rolled_back = [worker for worker in to_roll_back if worker.error_checking_out() == 0 and worker.error_locked() == 0]
+
+    horizontal_line()
+
+    longest_name = max((len(worker.display_name()) for worker in git_workers), default=0)
 
     for worker in git_workers:
-        worker.status()
+        if worker in failed:
+            result = TerminalStyle.RED + "Error(s): " + get_error_summary(worker)
+        elif worker in rolled_back:
+            result = TerminalStyle.YELLOW + "Rolled back to " + previous_heads[worker][1]
+        elif worker in switched and atomic and len(failed) > 0 and worker not in to_roll_back:
+            result = TerminalStyle.RED + "Couldn't roll back: previous HEAD unknown"
+        elif worker in switched and atomic and len(failed) > 0:
+            result = TerminalStyle.RED + "Couldn't roll back: " + get_error_summary(worker)
+        elif worker in switched:
+            result = TerminalStyle.GREEN + "Switched to " + branch_name
+        elif worker in already_on:
+            result = "Already on " + branch_name
+        elif worker in missing:
+            result = TerminalStyle.DIM + "No branch " + branch_name + ", skipped"
+        elif worker in held_by:
+            result = TerminalStyle.DIM + branch_name + " is checked out in " + held_by[worker].short_name() + ", skipped"
+        else:
+            continue
 
-    display_progress("Getting status", "error_getting_status")
+        print(worker.display_name().ljust(longest_name) + TerminalStyle.DIM + " [ " + TerminalStyle.CLEAR + result + TerminalStyle.CLEAR)
 
+    horizontal_line()
 
-def get_config_file_path():
+    return 0 if len(failed) == 0 else 1
 
-    return str(Path.home()) + "/.config/gbt.conf"
 
+def get_repository_workers(git_workers):
 
-def get_development_dir():
+    # Jobs that cover a whole repository (history, object store) would see
+    # the same repository again through each of its linked worktrees, so
+    # keep one worker per common git dir
+    common_git_dirs = set()
+    repository_workers = []
 
-    return " "
+    for worker in git_workers:
+        repository_dir = get_repository_dir(worker.directory())
 
+        if worker.is_worktree() or repository_dir in common_git_dirs:
+            continue
 
-def print_statuses(git_workers):
+        common_git_dirs.add(repository_dir)
+        repository_workers.append(worker)
 
-    horizontal_line()
+    return repository_workers
 
-    longest_subdirectory_name = 0
-    longest_branch_name = 0
-    longest_location = 0
+
+def log_all(git_workers, days_to_log, show_progress=True):
+
+    git_workers = get_repository_workers(git_workers)
 
     for worker in git_workers:
-        if len(worker.display_name()) > longest_subdirectory_name:
-            longest_subdirectory_name = len(worker.display_name())
+        worker.log(days_to_log)
+
+    if show_progress:
+        display_progress(git_workers, "Getting logs for last " + str(days_to_log) + " day(s)")
 
-        if len(worker.branch()) > longest_branch_name:
-            longest_branch_name = len(worker.branch())
 
-        if len(worker.location()) > longest_location:
-            longest_location = len(worker.location())
+def stats_all(git_workers, days_to_count, output_format):
 
-    output_lines = []
-    work_to_do = False
-    gbt_has_update = False
+    git_workers = get_repository_workers(git_workers)
 
     for worker in git_workers:
+        worker.stats(days_to_count)
 
-        if worker.error_occurred():
-            status_string = TerminalStyle.RED + worker.display_name().ljust(longest_subdirectory_name + longest_branch_name + longest_location + 10)
-            status_string += "Error(s): "
+    if output_format == "text":
+        display_progress(git_workers, "Reading " + str(days_to_count) + " day(s) of history")
+    else:
+        for worker in git_workers:
+            worker.join()
 
-            if worker.error_fetching() != 0:
-                status_string += "Fetching (" + str(worker.error_fetching()) + ")"
+    stats = get_commit_stats(git_workers)
 
-            if worker.error_pulling() != 0:
-                status_string += "Pulling (" + str(worker.error_pulling()) + ")"
+    if output_format == "json":
+        print(json.dumps(stats, indent=2))
+    else:
+        print_stats(stats, days_to_count)
 
-            if worker.error_checking_out() != 0:
-                status_string += "Checking out branch (" + str(worker.error_checking_out()) + ")"
+    failed = [worker for worker in git_workers if worker.error_getting_log() != 0]
 
-            status_string += TerminalStyle.CLEAR
+    for worker in failed:
+        print(TerminalStyle.RED + worker.display_name() + " Error(s): Getting log (" + str(worker.error_getting_log()) + ")" + TerminalStyle.CLEAR, file=sys.stderr)
 
-            print(status_string)
+    return 0 if len(failed) == 0 else 1
 
-        else:
-            name_string = TerminalStyle.DIM if worker.is_submodule() else ""
-            name_string += worker.display_name().ljust(longest_subdirectory_name)
-            name_string += TerminalStyle.CLEAR if worker.is_submodule() else ""
 
-            location_string = ""
+def fetch_all(git_workers, show_progress=True):
 
-            if "behind" in worker.location().lower():
+    fetch_shared_caches(git_workers)
 
-                gbt_has_update = worker.is_gbt_repo()
+    for worker in git_workers:
+        worker.fetch()
+
+    if show_progress:
+        display_progress(git_workers, "Fetching")
 
-                if len(worker.modified_files()) + len(worker.untracked_files()) > 0:
-                    location_string += TerminalStyle.RED
-                else:
-                    location_string += TerminalStyle.YELLOW
 
-                location_string += worker.location().rjust(longest_location)
-                work_to_do = True
+def status_all(git_workers):
 
-            elif "ahead" in worker.location().lower():
-                location_string += TerminalStyle.GREEN + worker.location().rjust(longest_location)
-                work_to_do = True
+    for worker in git_workers:
+        worker.status()
 
-            else:
-                location_string += worker.location().rjust(longest_location)
 
-            location_string += TerminalStyle.CLEAR
+def grep_all(git_workers, pattern, pathspecs, unordered=False, max_count=0):
 
-            branch_string = worker.branch().ljust(longest_branch_name)
+    for worker in git_workers:
+        worker.grep(pattern, pathspecs)
+
+    printed = [0] * len(git_workers)
+    pending = list(range(len(git_workers)))
+    match_count = 0
+    repos_matched = set()
+
+    while pending:
+        # In ordered mode only the first unfinished repository may print, so
+        # output stays grouped in repo order while later repos keep searching
+        candidates = pending if unordered else pending[:1]
+        progressed = False
+
+        for index in candidates:
+            worker = git_workers[index]
+            finished = not worker.work_in_progress()
+            lines = worker.grep_lines()
+            new_lines = lines[printed[index] :]
+
+            if max_count > 0:
+                new_lines = new_lines[: max_count - match_count]
+
+            if new_lines:
+                sys.stdout.write("\n".join(new_lines) + "\n")
+                printed[index] += len(new_lines)
+                match_count += len(new_lines)
+                repos_matched.add(index)
+                progressed = True
+
+            if max_count > 0 and match_count >= max_count:
+                for other in git_workers:
+                    other.cancel()
+                pending = []
+                break
+
+            if finished and printed[index] == len(lines):
+                pending.remove(index)
+                progressed = True
+
+        if pending and not progressed:
+            sleep(0.02)
+
+    sys.stdout.flush()
 
-            if worker.branch() != "master":
-                branch_string = TerminalStyle.WHITE + worker.branch().ljust(longest_branch_name) + TerminalStyle.CLEAR
+    for worker in git_workers:
+        worker.join()
 
-            status_string = ""
+        if worker.error_grepping() != 0:
+            print(TerminalStyle.RED + worker.display_name() + ": Error(s): Grepping (" + str(worker.error_grepping()) + ")" + TerminalStyle.CLEAR, file=sys.stderr)
 
-            if len(worker.modified_files()) + len(worker.untracked_files()) == 0:
-                status_string += TerminalStyle.BLUE + "Nothing to commit" + TerminalStyle.CLEAR
+    print(TerminalStyle.DIM + str(match_count) + " match(es) in " + str(len(repos_matched)) + " repo(s)" + TerminalStyle.CLEAR, file=sys.stderr)
 
-            else:
-                work_to_do = True
-                status_string += TerminalStyle.YELLOW
-                status_string += str(len(worker.modified_files()) + len(worker.untracked_files())) + " file(s) modified/untracked"
-                status_string += TerminalStyle.CLEAR
-
-            print(
-                name_string
-                + TerminalStyle.DIM
-                + " [ "
-                + TerminalStyle.CLEAR
-                + location_string
-                + TerminalStyle.DIM
-                + " on "
-                + TerminalStyle.CLEAR
-                + branch_string
-                + TerminalStyle.DIM
-                + " ] "
-                + TerminalStyle.CLEAR
-                + status_string
-            )
+    return 0 if match_count > 0 else 1
 
-    horizontal_line()
 
-    return work_to_do, gbt_has_update
+def exec_all(git_workers, command, timeout=None, fail_fast=False):
 
+    for worker in git_workers:
+        worker.run_command(command, timeout)
 
-def print_logs(git_workers):
+    finished = set()
+    next_to_print = 0
+
+    for worker in wait_for_workers(git_workers):
+        finished.add(worker)
+
+        if fail_fast and worker.error_running_command() != 0 and not worker.cancelled():
+            for other in git_workers:
+                other.cancel()
+
+        # Print each repo's buffered output once every repo before it is done,
+        # so the groups come out in repo order without interleaving
+        while next_to_print < len(git_workers) and git_workers[next_to_print] in finished:
+            print_command_output(git_workers[next_to_print])
+            next_to_print += 1
 
     horizontal_line()
 
-    all_log_entries = []
+    longest_name = max((len(worker.display_name()) for worker in git_workers), default=0)
+    failures = 0
 
     for worker in git_workers:
-        all_log_entries.extend(worker.log_entries())
+        if worker.cancelled():
+            result = TerminalStyle.DIM + "Cancelled"
+            failures += 1
+        elif worker.command_timed_out():
+            result = TerminalStyle.RED + "Timed out after " + str(timeout) + "s"
+            failures += 1
+        elif worker.error_running_command() != 0:
+            result = TerminalStyle.RED + "Exit status " + str(worker.error_running_command())
+            failures += 1
+        else:
+            result = TerminalStyle.GREEN + "OK"
 
-    all_log_entries.sort(key=lambda x: x.timestamp(), reverse=True)
+        print(worker.display_name().ljust(longest_name) + TerminalStyle.DIM + " [ " + TerminalStyle.CLEAR + result + TerminalStyle.CLEAR + " " + format(worker.job_duration(), ".1f") + "s")
 
-    longest_date = 0
-    longest_repo = 0
-    longest_author = 0
+    horizontal_line()
 
-    for entry in all_log_entries:
-        if len(entry.relative_date()) > longest_date:
-            longest_date = len(entry.relative_date())
+    return 0 if failures == 0 else 1
 
-        if len(entry.repo()) > longest_repo:
-            longest_repo = len(entry.repo())
 
-        if len(entry.author()) > longest_author:
-            longest_author = len(entry.author())
+def print_command_output(worker):
 
-    term_columns, term_lines = shutil.get_terminal_size((80, 20))
+    if worker.cancelled() and not worker.command_output() and not worker.command_errors():
+        return
 
-    for entry in all_log_entries:
-        repo_string = entry.repo().ljust(longest_repo)
-        date_string = entry.relative_date().ljust(longest_date)
-        author_string = entry.author().ljust(longest_author)
+    print(TerminalStyle.BOLD + "── " + worker.display_name() + " " + TerminalStyle.CLEAR)
+    sys.stdout.flush()
 
-        meta_data_string = repo_string + TerminalStyle.DIM + " [ " + TerminalStyle.CLEAR + author_string + " " + date_string + TerminalStyle.DIM + " ] " + TerminalStyle.CLEAR
-        message = entry.message()
-        space_remaining = term_columns - len(meta_data_string)
-        message_string = (message[: space_remaining - 3] + "...") if len(message) > space_remaining else message
+    sys.stdout.buffer.write(worker.command_output())
+    sys.stdout.buffer.flush()
 
-        print(meta_data_string + TerminalStyle.BLUE + message_string + TerminalStyle.CLEAR)
+    if worker.command_errors():
+        sys.stdout.write(TerminalStyle.RED)
+        sys.stdout.flush()
+        sys.stdout.buffer.write(worker.command_errors())
+        sys.stdout.write(TerminalStyle.CLEAR)
 
-    horizontal_line()
+    sys.stdout.flush()
 
 
-def horizontal_line():
+def read_clone_manifest(manifest_path):
 
-    term_columns, term_lines = shutil.get_terminal_size((80, 20))
-    print(TerminalStyle.DIM + "─" * term_columns + TerminalStyle.CLEAR)
+    manifest = configparser.ConfigParser()
+
+    with open(manifest_path) as manifest_file:
+        manifest.read_file(manifest_file)
+
+    entries = []
+
+    for target in manifest.sections():
+        section = manifest[target]
+
+        if "url" not in section:
+            raise ValueError("[" + target + "] has no url")
+
+        clone_options = []
+
+        if section.get("filter"):
+            clone_options.append("--filter=" + section["filter"])
+
+        if section.get("depth"):
+            clone_options.append("--depth=" + str(section.getint("depth")))
+
+        if section.getboolean("single_branch", fallback=False):
+            clone_options.append("--single-branch")
+
+        if section.get("branch"):
+            clone_options.append("--branch=" + section["branch"])
+
+        entries.append((os.path.join(str(Path.home()), os.path.expanduser(target)), section["url"], clone_options))
+
+    return entries
+
+
+def get_url_host(url):
+
+    if "://" in url:
+        return urlparse(url).hostname or "local"
+
+    # scp-like syntax, e.g. git@github.com:user/repo.git
+    match = re.match("^(?:[^@/]+@)?([^:/]+):", url)
+    if match:
+        return match.group(1)
+
+    return "local"
+
+
+def get_directory_size(directory):
+
+    size = 0
+
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+
+    return size
+
+
+def parse_bytes(value, unit):
+
+    return int(float(value) * {"B": 1, "bytes": 1, "KiB": 1024, "MiB": 1024 ** 2, "GiB": 1024 ** 3}.get(unit, 1))
+
+
+def format_bytes(size):
+
+    if size < 1024:
+        return str(int(size)) + " B"
+
+    for unit in ["KiB", "MiB", "GiB"]:
+        size /= 1024
+        if size < 1024 or unit == "GiB":
+            return format(size, ".1f") + " " + unit
+
+
+def is_clone_target_free(target):
+
+    # git clones into a missing or empty directory, and nothing else
+    if not os.path.lexists(target):
+        return True
+
+    try:
+        return os.path.isdir(target) and len(os.listdir(target)) == 0
+    except OSError:
+        return False
+
+
+def clone_all(manifest_path, max_per_host):
+
+    try:
+        entries = read_clone_manifest(manifest_path)
+    except (OSError, ValueError, configparser.Error) as error:
+        print(TerminalStyle.RED + "Couldn't read manifest: " + str(error) + TerminalStyle.CLEAR)
+        return 1
+
+    git_workers = []
+    host_slots = {}
+
+    for target, url, clone_options in entries:
+        if not is_clone_target_free(target):
+            print(TerminalStyle.DIM + os.path.basename(os.path.normpath(target)) + " already exists, skipping" + TerminalStyle.CLEAR)
+            continue
+
+        host = get_url_host(url)
+        if host not in host_slots:
+            host_slots[host] = BoundedSemaphore(max_per_host)
+
+        worker = GitStatusWorker(target, len(git_workers), 0)
+        worker.clone(url, clone_options, host_slots[host])
+        git_workers.append(worker)
+
+    if len(git_workers) == 0:
+        print(TerminalStyle.GREEN + "Nothing to clone" + TerminalStyle.CLEAR)
+        return 0
+
+    started = time()
+
+    horizontal_line()
+
+    longest_name = max(len(worker.display_name()) for worker in git_workers)
+    total_size = 0
+    failures = 0
+
+    for worker in wait_for_workers(git_workers):
+        if worker.error_cloning() != 0:
+            failures += 1
+            print(TerminalStyle.RED + worker.display_name().ljust(longest_name) + " Error(s): Cloning (" + str(worker.error_cloning()) + ") " + worker.command_errors().decode("UTF-8", "replace").strip().split("\n")[0] + TerminalStyle.CLEAR)
+            continue
+
+        size = get_directory_size(os.path.join(worker.directory(), ".git"))
+        total_size += size
+        rate = size / worker.job_duration() if worker.job_duration() > 0 else 0
+
+        print(worker.display_name().ljust(longest_name) + TerminalStyle.DIM + " [ " + TerminalStyle.CLEAR + format_bytes(size) + " in " + format(worker.job_duration(), ".1f") + "s, " + format_bytes(rate) + "/s" + TerminalStyle.DIM + " ]" + TerminalStyle.CLEAR)
+
+    elapsed = time() - started
+
+    horizontal_line()
+
+    print("Cloned " + str(len(git_workers) - failures) + " of " + str(len(git_workers)) + " repo(s), " + format_bytes(total_size) + " in " + format(elapsed, ".1f") + "s (" + format_bytes(total_size / elapsed if elapsed > 0 else 0) + "/s)")
+
+    return 0 if failures == 0 else 1
+
+
+def get_git_dir(directory):
+
+    git_path = os.path.join(directory, ".git")
+
+    # Submodules and linked worktrees have a .git file pointing at the real directory
+    if os.path.isfile(git_path):
+        with open(git_path) as git_file:
+            content = git_file.read().strip()
+
+        if content.startswith("gitdir: "):
+            return os.path.normpath(os.path.join(directory, content[len("gitdir: ") :]))
+
+    return git_path
+
+
+def get_common_git_dir(git_dir):
+
+    # Linked worktrees keep their refs in the main repository's git dir
+    try:
+        with open(os.path.join(git_dir, "commondir")) as commondir_file:
+            return os.path.normpath(os.path.join(git_dir, commondir_file.read().strip()))
+    except OSError:
+        return git_dir
+
+
+def get_repository_dir(directory):
+
+    # The same for a repository and all of its linked worktrees
+    return os.path.realpath(get_common_git_dir(get_git_dir(directory)))
+
+
+def read_head(directory):
+
+    try:
+        with open(os.path.join(get_git_dir(directory), "HEAD")) as head_file:
+            head = head_file.read().strip()
+    except OSError:
+        return ("unknown", "")
+
+    if head.startswith("ref: refs/heads/"):
+        return ("branch", head[len("ref: refs/heads/") :])
+
+    return ("detached", head)
+
+
+def has_branch(directory, branch_name):
+
+    common_dir = get_common_git_dir(get_git_dir(directory))
+
+    if os.path.isfile(os.path.join(common_dir, "refs", "heads", branch_name)):
+        return True
+
+    remotes_dir = os.path.join(common_dir, "refs", "remotes")
+
+    try:
+        remotes = os.listdir(remotes_dir)
+    except OSError:
+        remotes = []
+
+    for remote in remotes:
+        if os.path.isfile(os.path.join(remotes_dir, remote, branch_name)):
+            return True
+
+    try:
+        with open(os.path.join(common_dir, "packed-refs")) as packed_refs_file:
+            for line in packed_refs_file:
+                ref_name = line.rstrip("\n").partition(" ")[2]
+
+                if ref_name == "refs/heads/" + branch_name:
+                    return True
+
+                if ref_name.startswith("refs/remotes/") and ref_name.split("/", 3)[-1] == branch_name:
+                    return True
+    except OSError:
+        pass
+
+    return False
+
+
+def get_shared_cache_root():
+
+    return os.path.join(str(Path.home()), ".cache", "gbt", "objects")
+
+
+def get_shared_cache_dir(url):
+
+    normalised_url = url.rstrip("/")
+    if normalised_url.endswith(".git"):
+        normalised_url = normalised_url[: -len(".git")]
+
+    name = os.path.basename(normalised_url.replace(":", "/")) or "repo"
+    digest = hashlib.sha1(normalised_url.encode("UTF-8")).hexdigest()[:12]
+
+    return os.path.join(get_shared_cache_root(), name + "-" + digest + ".git")
+
+
+def get_alternates_path(directory):
+
+    return os.path.join(get_git_dir(directory), "objects", "info", "alternates")
+
+
+def read_alternates(directory):
+
+    try:
+        with open(get_alternates_path(directory)) as alternates_file:
+            return [line.strip() for line in alternates_file if line.strip()]
+    except OSError:
+        return []
+
+
+def write_alternates(directory, alternates):
+
+    alternates_path = get_alternates_path(directory)
+
+    if len(alternates) == 0:
+        if os.path.exists(alternates_path):
+            os.remove(alternates_path)
+        return
+
+    os.makedirs(os.path.dirname(alternates_path), exist_ok=True)
+
+    with open(alternates_path, "w") as alternates_file:
+        alternates_file.write("\n".join(alternates) + "\n")
+
+
+def get_shared_caches(git_workers):
+
+    cache_root = get_shared_cache_root() + os.sep
+    caches = set()
+
+    for worker in git_workers:
+        for alternate in read_alternates(worker.directory()):
+            if alternate.startswith(cache_root):
+                caches.add(os.path.dirname(alternate))
+
+    return sorted(caches)
+
+
+def fetch_shared_caches(git_workers):
+
+    # Fetch each shared upstream once up front, so the clones borrowing its
+    # objects only have to update their refs
+    cache_workers = [GitStatusWorker(cache_dir, index, 0) for index, cache_dir in enumerate(get_shared_caches(git_workers))]
+
+    for worker in cache_workers:
+        worker.fetch()
+
+    for worker in wait_for_workers(cache_workers):
+        if worker.error_fetching() != 0:
+            print(TerminalStyle.RED + "Fetching shared cache " + worker.short_name() + " failed (" + str(worker.error_fetching()) + ")" + TerminalStyle.CLEAR, file=sys.stderr)
+
+
+def get_remote_url(directory):
+
+    try:
+        output = check_output(["git", "config", "--get", "remote.origin.url"], cwd=directory, stderr=PIPE)
+    except (OSError, CalledProcessError):
+        return ""
+
+    return output.decode("UTF-8").strip()
+
+
+def create_shared_cache(cache_dir, url):
+
+    if os.path.isdir(cache_dir):
+        return
+
+    os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+
+    for command in [
+        ["git", "init", "--quiet", "--bare", cache_dir],
+        ["git", "-C", cache_dir, "config", "remote.origin.url", url],
+        ["git", "-C", cache_dir, "config", "remote.origin.fetch", "+refs/heads/*:refs/heads/*"],
+        ["git", "-C", cache_dir, "config", "remote.origin.tagOpt", "--tags"],
+        # Clones depend on these objects, so the cache must never drop any
+        ["git", "-C", cache_dir, "config", "gc.auto", "0"],
+        ["git", "-C", cache_dir, "config", "gc.pruneExpire", "never"],
+    ]:
+        check_output(command, stderr=PIPE)
+
+
+def share_all(git_workers):
+
+    upstreams = {}
+
+    for worker in get_repository_workers(git_workers):
+        if worker.is_submodule():
+            continue
+
+        url = get_remote_url(worker.directory())
+        if url:
+            upstreams.setdefault(url, []).append(worker)
+
+    shared = {url: workers for url, workers in upstreams.items() if len(workers) > 1}
+
+    if len(shared) == 0:
+        print(TerminalStyle.GREEN + "No repositories share an upstream" + TerminalStyle.CLEAR)
+        return 0
+
+    cache_workers = []
+
+    for url in sorted(shared):
+        cache_dir = get_shared_cache_dir(url)
+
+        try:
+            create_shared_cache(cache_dir, url)
+        except CalledProcessError as error:
+            print(TerminalStyle.RED + "Couldn't create shared cache for " + url + ": " + error.stderr.decode("UTF-8", "replace").strip() + TerminalStyle.CLEAR)
+            continue
+
+        cache_workers.append(GitStatusWorker(cache_dir, len(cache_workers), 0))
+
+    for worker in cache_workers:
+        worker.fetch()
+
+    failed_caches = set()
+
+    for worker in wait_for_workers(cache_workers):
+        if worker.error_fetching() != 0:
+            failed_caches.add(worker.directory())
+            print(TerminalStyle.RED + "Fetching shared cache " + worker.short_name() + " failed (" + str(worker.error_fetching()) + ")" + TerminalStyle.CLEAR)
+
+    wired_workers = []
+
+    for url in sorted(shared):
+        cache_dir = get_shared_cache_dir(url)
+
+        if not os.path.isdir(cache_dir) or cache_dir in failed_caches:
+            continue
+
+        cache_objects = os.path.join(cache_dir, "objects")
+
+        for worker in shared[url]:
+            alternates = read_alternates(worker.directory())
+
+            if cache_objects not in alternates:
+                write_alternates(worker.directory(), alternates + [cache_objects])
+
+            wired_workers.append(worker)
+
+        print(url + TerminalStyle.DIM + " [ " + TerminalStyle.CLEAR + str(len(shared[url])) + " clones share " + cache_dir + TerminalStyle.DIM + " ]" + TerminalStyle.CLEAR)
+
+    # Drop the objects each clone now borrows from its cache
+    for worker in wired_workers:
+        worker.run_command(["git", "repack", "-a", "-d", "-l", "-q"])
+
+    failures = 0
+
+    for worker in wait_for_workers(wired_workers):
+        if worker.error_running_command() != 0:
+            failures += 1
+            print(TerminalStyle.RED + worker.display_name() + ": Error(s): Repacking (" + str(worker.error_running_command()) + ")" + TerminalStyle.CLEAR)
+
+    return 0 if failures == 0 and len(failed_caches) == 0 else 1
+
+
+def unshare_all(git_workers):
+
+    cache_root = get_shared_cache_root() + os.sep
+    shared_workers = [worker for worker in get_repository_workers(git_workers) if any(alternate.startswith(cache_root) for alternate in read_alternates(worker.directory()))]
+
+    if len(shared_workers) == 0:
+        print(TerminalStyle.GREEN + "No repositories use a shared cache" + TerminalStyle.CLEAR)
+        return 0
+
+    # Copy every borrowed object back into the clone before unwiring it
+    for worker in shared_workers:
+        worker.run_command(["git", "repack", "-a", "-d", "-q"])
+
+    failures = 0
+
+    for worker in wait_for_workers(shared_workers):
+        if worker.error_running_command() != 0:
+            failures += 1
+            print(TerminalStyle.RED + worker.display_name() + ": Error(s): Repacking (" + str(worker.error_running_command()) + "), still shared" + TerminalStyle.CLEAR)
+            continue
+
+        alternates = read_alternates(worker.directory())
+        write_alternates(worker.directory(), [alternate for alternate in alternates if not alternate.startswith(cache_root)])
+
+        check = Popen(["git", "fsck", "--connectivity-only", "--no-dangling", "--no-progress"], stdout=PIPE, stderr=PIPE, cwd=worker.directory())
+        check.communicate()
+
+        if check.returncode != 0:
+            write_alternates(worker.directory(), alternates)
+            failures += 1
+            print(TerminalStyle.RED + worker.display_name() + ": Error(s): Objects missing after repack, still shared" + TerminalStyle.CLEAR)
+        else:
+            print(worker.display_name() + TerminalStyle.DIM + " [ " + TerminalStyle.CLEAR + "Detached from shared cache" + TerminalStyle.DIM + " ]" + TerminalStyle.CLEAR)
+
+    return 0 if failures == 0 else 1
+
+
+def get_low_priority_prefix():
+
+    prefix = []
+
+    if shutil.which("ionice"):
+        prefix += ["ionice", "-c", "3"]
+
+    if shutil.which("nice"):
+        prefix += ["nice", "-n", "19"]
+
+    return prefix
+
+
+def lower_process_priority():
+
+    # Threads and child processes inherit both priorities, so this has to run
+    # before any worker starts for every git process to pick them up
+    os.nice(19)
+
+    if shutil.which("ionice"):
+        try:
+            check_output(["ionice", "-c", "3", "-p", str(os.getpid())], stderr=DEVNULL)
+        except CalledProcessError:
+            pass
+
+
+def maintain_all(git_workers):
+
+    git_workers = get_repository_workers(git_workers)
+    command_prefix = get_low_priority_prefix()
+
+    for worker in git_workers:
+        worker.maintain(command_prefix)
+
+    horizontal_line()
+
+    longest_name = max((len(worker.display_name()) for worker in git_workers), default=0)
+    failures = 0
+
+    for worker in wait_for_workers(git_workers):
+        if worker.error_maintaining() != 0:
+            failures += 1
+            print(TerminalStyle.RED + worker.display_name().ljust(longest_name) + " Error(s): Maintaining (" + str(worker.error_maintaining()) + ") " + worker.command_errors().decode("UTF-8", "replace").strip().split("\n")[0] + TerminalStyle.CLEAR)
+            continue
+
+        timings = []
+
+        for name, (before, after) in worker.maintenance_timings().items():
+            change = (after - before) / before if before > 0 else 0.0
+
+            if change <= -0.1:
+                style = TerminalStyle.GREEN
+            elif change >= 0.1:
+                style = TerminalStyle.RED
+            else:
+                style = ""
+
+            timings.append(name + " " + format(before * 1000, ".1f") + "ms → " + style + format(after * 1000, ".1f") + "ms (" + format(change * 100, "+.0f") + "%)" + TerminalStyle.CLEAR)
+
+        print(worker.display_name().ljust(longest_name) + TerminalStyle.DIM + " [ " + TerminalStyle.CLEAR + format(worker.job_duration(), ".1f") + "s" + TerminalStyle.DIM + " ] " + TerminalStyle.CLEAR + ", ".join(timings))
+
+    horizontal_line()
+
+    return 0 if failures == 0 else 1
+
+
+def browse_all(git_workers, refresh_interval):
+
+    # Imported here, so commands other than tui don't pay for it
+    global curses
+    import curses
+
+    if not sys.stdout.isatty():
+        print("gbt tui needs a terminal")
+        return 1
+
+    if len(git_workers) == 0:
+        print("No repositories found")
+        return 1
+
+    browser = StatusBrowser(git_workers, refresh_interval)
+    curses.wrapper(browser.run)
+
+    return 0
+
+
+def get_max_workers():
+
+    max_workers = get_config_value(ConfigValue.MAX_WORKERS)
+
+    if max_workers.isdigit() and int(max_workers) > 0:
+        return int(max_workers)
+
+    return max(4, (os.cpu_count() or 1) * 2)
+
+
+def get_background_limits():
+
+    disk_jobs = get_config_value(ConfigValue.BACKGROUND_DISK_JOBS)
+    network_jobs = get_config_value(ConfigValue.BACKGROUND_NETWORK_JOBS)
+    max_load = get_config_value(ConfigValue.BACKGROUND_MAX_LOAD)
+
+    disk_jobs = int(disk_jobs) if disk_jobs.isdigit() and int(disk_jobs) > 0 else 2
+    network_jobs = int(network_jobs) if network_jobs.isdigit() and int(network_jobs) > 0 else 4
+
+    try:
+        max_load = float(max_load)
+    except ValueError:
+        max_load = float(os.cpu_count() or 1)
+
+    return disk_jobs, network_jobs, max_load
+
+
+def get_lock_timeout():
+
+    lock_timeout = get_config_value(ConfigValue.LOCK_TIMEOUT)
+
+    try:
+        return float(lock_timeout)
+    except ValueError:
+        return 10.0
+
+
+def get_prompt_stale_after():
+
+    prompt_stale_after = get_config_value(ConfigValue.PROMPT_STALE_AFTER)
+
+    try:
+        return float(prompt_stale_after)
+    except ValueError:
+        return 900.0
+
+
+def get_config_file_path():
+
+    return str(Path.home()) + "/.config/gbt.conf"
+
+
+def get_development_dir():
+
+    return " "
+
+
+class StatusTable:
+    def __init__(self, git_workers, stream=sys.stdout):
+
+        self._workers = git_workers
+        self._stream = stream
+        # Redrawing moves the cursor back up over the table, which can't reach
+        # rows that have scrolled off, so taller tables stream instead
+        self._live = stream.isatty() and len(git_workers) < shutil.get_terminal_size().lines
+        self._finished = set()
+        self._lines_drawn = 0
+
+        self._name_width = max((len(worker.display_name()) for worker in git_workers), default=0)
+        self._branch_width = 0
+        self._location_width = 0
+
+        self._work_to_do = False
+        self._gbt_has_update = False
+
+    def work_to_do(self):
+
+        return self._work_to_do
+
+    def gbt_has_update(self):
+
+        return self._gbt_has_update
+
+    def begin(self):
+
+        if self._live:
+            self._draw_frame()
+
+    def add(self, worker):
+
+        self._finished.add(worker)
+        self._branch_width = max(self._branch_width, len(worker.branch()))
+        self._location_width = max(self._location_width, len(worker.location()))
+
+        if not worker.error_occurred():
+            dirty = len(worker.modified_files()) + len(worker.untracked_files()) > 0
+            location = worker.location().lower()
+
+            if dirty or "behind" in location or "ahead" in location:
+                self._work_to_do = True
+
+            if "behind" in location and worker.is_gbt_repo():
+                self._gbt_has_update = True
+
+        if self._live:
+            self._draw_frame()
+            return
+
+        # Keep rows in repo order when streaming, so submodules and worktrees
+        # stay grouped under their parent
+        rows = []
+
+        while self._lines_drawn < len(self._workers) and self._workers[self._lines_drawn] in self._finished:
+            rows.append(self._row(self._workers[self._lines_drawn]) + "\n")
+            self._lines_drawn += 1
+
+        if rows:
+            self._stream.write("".join(rows))
+            self._stream.flush()
+
+    def _draw_frame(self):
+
+        frame = []
+
+        if self._lines_drawn > 0:
+            frame.append("\033[" + str(self._lines_drawn) + "F")
+
+        for worker in self._workers:
+            if worker in self._finished:
+                frame.append(self._row(worker))
+            else:
+                frame.append(TerminalStyle.DIM + worker.display_name().ljust(self._name_width) + " [ … ]" + TerminalStyle.CLEAR)
+            frame.append("\033[K\n")
+
+        self._lines_drawn = len(self._workers)
+        self._stream.write("".join(frame))
+        self._stream.flush()
+
+    def _row(self, worker):
+
+        if worker.error_occurred():
+            return "".join(
+                [
+                    TerminalStyle.RED,
+                    worker.display_name().ljust(self._name_width + self._branch_width + self._location_width + 10),
+                    "Error(s): ",
+                    get_error_summary(worker),
+                    TerminalStyle.CLEAR,
+                ]
+            )
+
+        name_style = TerminalStyle.DIM if worker.is_submodule() else ""
+        location = worker.location()
+        location_lower = location.lower()
+        changed_files = len(worker.modified_files()) + len(worker.untracked_files())
+
+        if "behind" in location_lower:
+            location_style = TerminalStyle.RED if changed_files > 0 else TerminalStyle.YELLOW
+        elif "ahead" in location_lower:
+            location_style = TerminalStyle.GREEN
+        else:
+            location_style = ""
+
+        branch_style = TerminalStyle.WHITE if worker.branch() != "master" else ""
+
+        if changed_files == 0:
+            status = TerminalStyle.BLUE + "Nothing to commit"
+        else:
+            status = TerminalStyle.YELLOW + str(changed_files) + " file(s) modified/untracked"
+
+        return "".join(
+            [
+                name_style,
+                worker.display_name().ljust(self._name_width),
+                TerminalStyle.CLEAR,
+                TerminalStyle.DIM,
+                " [ ",
+                TerminalStyle.CLEAR,
+                location_style,
+                location.rjust(self._location_width),
+                TerminalStyle.CLEAR,
+                TerminalStyle.DIM,
+                " on ",
+                TerminalStyle.CLEAR,
+                branch_style,
+                worker.branch().ljust(self._branch_width),
+                TerminalStyle.CLEAR,
+                TerminalStyle.DIM,
+                " ] ",
+                TerminalStyle.CLEAR,
+                status,
+                TerminalStyle.CLEAR,
+            ]
+        )
+
+
+def is_lock_error(stderr):
+
+    stderr = stderr.decode("UTF-8", "replace") if isinstance(stderr, bytes) else stderr
+
+    # Only wait on another process holding a lock file. "cannot lock ref" is
+    # also reported for lasting ref conflicts, which retrying won't fix
+    return ".lock': File exists" in stderr or "Another git process seems to be running" in stderr
+
+
+def get_error_summary(worker):
+
+    errors = []
+
+    if worker.error_locked() != 0:
+        errors.append("Locked by another git process (" + str(worker.error_locked()) + ")")
+
+    if worker.error_getting_status() != 0:
+        errors.append("Getting status (" + str(worker.error_getting_status()) + ")")
+
+    if worker.error_fetching() != 0:
+        errors.append("Fetching (" + str(worker.error_fetching()) + ")")
+
+    if worker.error_pulling() != 0:
+        errors.append("Pulling (" + str(worker.error_pulling()) + ")")
+
+    if worker.error_checking_out() != 0:
+        errors.append("Checking out branch (" + str(worker.error_checking_out()) + ")")
+
+    return ", ".join(errors)
+
+
+def wait_for_workers(git_workers, poll_interval=0.05):
+
+    pending = list(git_workers)
+
+    while pending:
+        still_busy = []
+
+        for worker in pending:
+            if worker.work_in_progress():
+                still_busy.append(worker)
+            else:
+                worker.join()
+                yield worker
+
+        pending = still_busy
+
+        if pending:
+            sleep(poll_interval)
+
+
+def print_statuses(git_workers):
+
+    horizontal_line()
+
+    table = StatusTable(git_workers)
+    table.begin()
+
+    for worker in wait_for_workers(git_workers):
+        table.add(worker)
+
+    horizontal_line()
+
+    return table.work_to_do(), table.gbt_has_update()
+
+
+def write_prompt_summary(git_workers):
+
+    dirty = len([worker for worker in git_workers if worker.modified_files() or worker.untracked_files()])
+    behind = len([worker for worker in git_workers if worker.behind() > 0])
+    ahead = len([worker for worker in git_workers if worker.ahead() > 0])
+    errors = len([worker for worker in git_workers if worker.error_occurred()])
+
+    summary = struct.pack(PROMPT_SUMMARY_FORMAT, PROMPT_SUMMARY_MAGIC, PROMPT_SUMMARY_VERSION, time(), get_prompt_stale_after(), len(git_workers), dirty, behind, ahead, errors)
+
+    summary_path = get_prompt_summary_path()
+    temporary_path = summary_path + "." + str(os.getpid())
+
+    try:
+        os.makedirs(os.path.dirname(summary_path), exist_ok=True)
+        with open(temporary_path, "wb") as summary_file:
+            summary_file.write(summary)
+        os.replace(temporary_path, summary_path)
+    except OSError:
+        pass
+
+
+def get_worker_record(worker, operation):
+
+    record = {
+        "repo": worker.short_name(),
+        "directory": worker.directory(),
+        "operation": operation,
+        "errors": {
+            "fetching": worker.error_fetching(),
+            "pulling": worker.error_pulling(),
+            "checking_out": worker.error_checking_out(),
+            "getting_status": worker.error_getting_status(),
+            "getting_log": worker.error_getting_log(),
+            "grepping": worker.error_grepping(),
+            "running_command": worker.error_running_command(),
+            "cloning": worker.error_cloning(),
+            "maintaining": worker.error_maintaining(),
+            "locked": worker.error_locked(),
+        },
+        "duration": round(worker.job_duration(), 3),
+    }
+
+    if operation == "status":
+        record["branch"] = worker.branch()
+        record["location"] = worker.location()
+        record["ahead"] = worker.ahead()
+        record["behind"] = worker.behind()
+        record["modified"] = len(worker.modified_files())
+        record["untracked"] = len(worker.untracked_files())
+
+    elif operation == "log":
+        record["entries"] = [
+            {"timestamp": int(entry.timestamp()), "relative_date": entry.relative_date(), "author": entry.author(), "message": entry.message()}
+            for entry in worker.log_entries()
+        ]
+
+    return record
+
+
+def print_records(git_workers, operation, output_format):
+
+    records = []
+
+    for worker in wait_for_workers(git_workers):
+        record = get_worker_record(worker, operation)
+
+        if output_format == "ndjson":
+            sys.stdout.write(json.dumps(record) + "\n")
+            sys.stdout.flush()
+        else:
+            records.append(record)
+
+    records.sort(key=lambda x: x["directory"])
+
+    return records
+
+
+class StatusBrowser:
+
+    COLOURS = {"green": 1, "yellow": 2, "red": 3, "blue": 4, "white": 5}
+
+    def __init__(self, git_workers, refresh_interval):
+
+        self._workers = git_workers
+        self._refresh_interval = refresh_interval
+        self._cursor = 0
+        self._top = 0
+        self._selected = set()
+        self._needs_status = set()
+        self._last_refresh = 0.0
+        self._message = ""
+
+    def run(self, screen):
+
+        curses.curs_set(0)
+        curses.use_default_colors()
+
+        for name, pair in self.COLOURS.items():
+            curses.init_pair(pair, getattr(curses, "COLOR_" + name.upper()), -1)
+
+        screen.timeout(200)
+
+        while True:
+            self._schedule()
+            self._draw(screen)
+
+            key = screen.getch()
+
+            if key in (ord("q"), 27):
+                break
+
+            self._handle_key(screen, key)
+
+        for worker in self._workers:
+            worker.cancel()
+
+    def _schedule(self):
+
+        # Re-read the status of repos whose fetch, pull or checkout just ended
+        for worker in list(self._needs_status):
+            if not worker.work_in_progress():
+                self._needs_status.discard(worker)
+                worker.status()
+
+        if time() - self._last_refresh >= self._refresh_interval:
+            self._last_refresh = time()
+
+            for worker in self._workers:
+                if worker not in self._needs_status:
+                    worker.status()
+
+    def _targets(self):
+
+        if self._selected:
+            return [self._workers[index] for index in sorted(self._selected)]
+
+        return [self._workers[self._cursor]] if self._workers else []
+
+    def _run_action(self, name, action):
+
+        targets = [worker for worker in self._targets() if not worker.work_in_progress()]
+
+        for worker in targets:
+            action(worker)
+            self._needs_status.add(worker)
+
+        self._message = name + " " + str(len(targets)) + " repo(s)"
+        self._selected.clear()
+
+    def _handle_key(self, screen, key):
+
+        if key in (curses.KEY_UP, ord("k")):
+            self._cursor = max(0, self._cursor - 1)
+
+        elif key in (curses.KEY_DOWN, ord("j")):
+            self._cursor = min(len(self._workers) - 1, self._cursor + 1)
+
+        elif key == ord(" "):
+            self._selected ^= {self._cursor}
+            self._cursor = min(len(self._workers) - 1, self._cursor + 1)
+
+        elif key == ord("a"):
+            all_selected = len(self._selected) == len(self._workers)
+            self._selected = set() if all_selected else set(range(len(self._workers)))
+
+        elif key == ord("f"):
+            self._run_action("Fetching", lambda worker: worker.fetch())
+
+        elif key == ord("p"):
+            self._run_action("Pulling", lambda worker: worker.pull())
+
+        elif key == ord("c"):
+            branch_name = self._prompt(screen, "Checkout branch: ")
+            if branch_name:
+                self._run_action("Checking out " + branch_name + " in", lambda worker: worker.checkout(branch_name))
+
+        elif key == ord("r"):
+            self._run_action("Refreshing", lambda worker: None)
+
+    def _prompt(self, screen, text):
+
+        height, width = screen.getmaxyx()
+
+        screen.timeout(-1)
+        curses.echo()
+        curses.curs_set(1)
+
+        screen.move(height - 1, 0)
+        screen.clrtoeol()
+        screen.addnstr(height - 1, 0, text, width - 1)
+        value = screen.getstr(height - 1, len(text), width - len(text) - 1).decode("UTF-8", "replace").strip()
+
+        curses.curs_set(0)
+        curses.noecho()
+        screen.timeout(200)
+
+        return value
+
+    def _draw(self, screen):
+
+        height, width = screen.getmaxyx()
+        rows = max(1, height - 3)
+
+        if self._cursor < self._top:
+            self._top = self._cursor
+        elif self._cursor >= self._top + rows:
+            self._top = self._cursor - rows + 1
+
+        name_width = max((len(worker.display_name()) for worker in self._workers), default=0)
+        branch_width = max((len(worker.branch()) for worker in self._workers), default=0)
+        location_width = max((len(worker.location()) for worker in self._workers), default=0)
+
+        screen.erase()
+        screen.addnstr(0, 0, "gbt  [space] select  [a] all  [f] fetch  [p] pull  [c] checkout  [r] refresh  [q] quit", width - 1, curses.A_DIM)
+
+        for row, index in enumerate(range(self._top, min(len(self._workers), self._top + rows))):
+            worker = self._workers[index]
+            y = row + 1
+            attributes = curses.A_REVERSE if index == self._cursor else curses.A_NORMAL
+
+            marker = "*" if index in self._selected else " "
+            busy = "…" if worker.work_in_progress() or worker in self._needs_status else " "
+            screen.addnstr(y, 0, marker + busy + " " + worker.display_name().ljust(name_width) + " ", width - 1, attributes)
+
+            x = name_width + 4
+            if x >= width - 1:
+                continue
+
+            if worker.error_occurred():
+                screen.addnstr(y, x, "Error(s): " + get_error_summary(worker), width - 1 - x, curses.color_pair(self.COLOURS["red"]))
+                continue
+
+            changed_files = len(worker.modified_files()) + len(worker.untracked_files())
+            location = worker.location().lower()
+
+            if "behind" in location:
+                location_colour = self.COLOURS["red"] if changed_files > 0 else self.COLOURS["yellow"]
+            elif "ahead" in location:
+                location_colour = self.COLOURS["green"]
+            else:
+                location_colour = 0
+
+            branch_colour = self.COLOURS["white"] if worker.branch() != "master" else 0
+
+            if changed_files == 0:
+                changes, changes_colour = "Nothing to commit", self.COLOURS["blue"]
+            else:
+                changes, changes_colour = str(changed_files) + " file(s) modified/untracked", self.COLOURS["yellow"]
+
+            for text, colour in [
+                (worker.location().rjust(location_width), location_colour),
+                (" on ", -1),
+                (worker.branch().ljust(branch_width), branch_colour),
+                ("  ", -1),
+                (changes, changes_colour),
+            ]:
+                if x >= width - 1:
+                    break
+
+                screen.addnstr(y, x, text, width - 1 - x, curses.A_DIM if colour < 0 else curses.color_pair(colour))
+                x += len(text)
+
+        screen.addnstr(height - 1, 0, self._message, width - 1, curses.A_DIM)
+        screen.refresh()
+
+
+def import_numpy():
+
+    # Imported on first use, so commands other than stats don't pay for it
+    global numpy
+
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+
+
+def count_occurrences(values, size):
+
+    if numpy is not None:
+        return numpy.bincount(values, minlength=size).tolist()
+
+    counts = [0] * size
+
+    for value, count in Counter(values).items():
+        counts[value] = count
+
+    return counts
+
+
+def combine_keys(high, scale, low):
+
+    if numpy is not None:
+        return high * scale + low
+
+    return array("q", [high_value * scale + low_value for high_value, low_value in zip(high, low)])
+
+
+def count_distinct_pairs(high, scale, low, size):
+
+    keys = combine_keys(high, scale, low)
+
+    if numpy is not None:
+        return count_occurrences(numpy.unique(keys) // scale, size)
+
+    return count_occurrences([key // scale for key in set(keys)], size)
+
+
+def get_local_times(times):
+
+    # The UTC offset moves with daylight saving time, but only ever on an
+    # hour boundary, so look it up once per hour that has commits
+    if numpy is not None:
+        times = numpy.frombuffer(times, dtype=numpy.int64)
+        utc_hours, hour_index = numpy.unique(times // 3600, return_inverse=True)
+        offsets = numpy.array([localtime(int(hour) * 3600).tm_gmtoff for hour in utc_hours], dtype=numpy.int64)
+
+        return times + offsets[hour_index]
+
+    offsets = {}
+
+    def local_time(timestamp):
+        hour = timestamp // 3600
+
+        if hour not in offsets:
+            offsets[hour] = localtime(hour * 3600).tm_gmtoff
+
+        return timestamp + offsets[hour]
+
+    return array("q", map(local_time, times))
+
+
+def get_commit_stats(git_workers):
+
+    import_numpy()
+
+    author_names = {}
+    times = array("q")
+    authors = array("q")
+    repos = array("q")
+
+    # Everything below works on flat integer arrays, one entry per commit,
+    # so years of history across many repos never becomes Python objects
+    for repo_id, worker in enumerate(git_workers):
+        author_map = [author_names.setdefault(name, len(author_names)) for name in worker.commit_author_names()]
+
+        times.extend(worker.commit_times())
+        authors.extend(array("q", map(author_map.__getitem__, worker.commit_authors())))
+        repos.extend(array("q", [repo_id]) * len(worker.commit_times()))
+
+    local_times = get_local_times(times)
+
+    if len(local_times) == 0:
+        first_day = 0
+        day_count = 0
+    elif numpy is not None:
+        first_day = int(local_times.min()) // 86400
+        day_count = int(local_times.max()) // 86400 - first_day + 1
+    else:
+        first_day = min(local_times) // 86400
+        day_count = max(local_times) // 86400 - first_day + 1
+
+    if numpy is not None:
+        days = local_times // 86400 - first_day
+        hours = local_times // 3600 % 24
+        authors = numpy.frombuffer(authors, dtype=numpy.int64)
+        repos = numpy.frombuffer(repos, dtype=numpy.int64)
+    else:
+        days = array("q", [timestamp // 86400 - first_day for timestamp in local_times])
+        hours = array("q", [timestamp // 3600 % 24 for timestamp in local_times])
+
+    author_count = len(author_names)
+    repo_count = len(git_workers)
+
+    author_commits = count_occurrences(authors, author_count)
+    author_days = count_distinct_pairs(authors, day_count, days, author_count)
+    author_hours = count_occurrences(combine_keys(authors, 24, hours), author_count * 24)
+
+    repo_commits = count_occurrences(repos, repo_count)
+    repo_days = count_distinct_pairs(repos, day_count, days, repo_count)
+    repo_authors = count_distinct_pairs(repos, author_count, authors, repo_count)
+
+    day_commits = count_occurrences(days, day_count)
+
+    stats = {
+        "commits": len(times),
+        "authors": [],
+        "repos": [],
+        "days": {},
+        "hours": count_occurrences(hours, 24),
+    }
+
+    for author_id, name in enumerate(author_names):
+        hour_counts = author_hours[author_id * 24 : (author_id + 1) * 24]
+
+        stats["authors"].append({
+            "author": name,
+            "commits": author_commits[author_id],
+            "active_days": author_days[author_id],
+            "busiest_hour": hour_counts.index(max(hour_counts)),
+        })
+
+    for repo_id, worker in enumerate(git_workers):
+        stats["repos"].append({
+            "repo": worker.short_name(),
+            "directory": worker.directory(),
+            "commits": repo_commits[repo_id],
+            "authors": repo_authors[repo_id],
+            "active_days": repo_days[repo_id],
+        })
+
+    for day, commits in enumerate(day_commits):
+        if commits > 0:
+            stats["days"][datetime.date.fromordinal(datetime.date(1970, 1, 1).toordinal() + first_day + day).isoformat()] = commits
+
+    return stats
+
+
+def print_stats(stats, days_to_count):
+
+    horizontal_line()
+
+    print(TerminalStyle.BOLD + str(stats["commits"]) + " commit(s) by " + str(len(stats["authors"])) + " author(s) in the last " + str(days_to_count) + " day(s)" + TerminalStyle.CLEAR)
+
+    for title, key, rows, columns in [
+        ("Repository", "repo", stats["repos"], ["commits", "authors", "active_days"]),
+        ("Author", "author", stats["authors"], ["commits", "active_days", "busiest_hour"]),
+    ]:
+        rows = sorted((row for row in rows if row["commits"] > 0), key=lambda row: row["commits"], reverse=True)
+
+        if len(rows) == 0:
+            continue
+
+        horizontal_line()
+
+        longest_name = max(len(title), max(len(row[key]) for row in rows))
+        widths = [max(len(column), max(len(str(row[column])) for row in rows)) for column in columns]
+        header = "  ".join(column.replace("_", " ").rjust(width) for column, width in zip(columns, widths))
+
+        print(TerminalStyle.DIM + title.ljust(longest_name) + " [ " + header + " ]" + TerminalStyle.CLEAR)
+
+        for row in rows:
+            values = "  ".join((("%02d:00" % row[column]) if column == "busiest_hour" else str(row[column])).rjust(width) for column, width in zip(columns, widths))
+
+            print(row[key].ljust(longest_name) + TerminalStyle.DIM + " [ " + TerminalStyle.CLEAR + values + TerminalStyle.DIM + " ]" + TerminalStyle.CLEAR)
+
+    if stats["commits"] > 0:
+        horizontal_line()
+
+        busiest_days = sorted(stats["days"].items(), key=lambda item: item[1], reverse=True)[:5]
+        print("Busiest days".ljust(13) + TerminalStyle.DIM + " [ " + TerminalStyle.CLEAR + ", ".join(day + " (" + str(commits) + ")" for day, commits in busiest_days) + TerminalStyle.DIM + " ]" + TerminalStyle.CLEAR)
+
+        blocks = " \u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588"
+        busiest_hour = max(stats["hours"])
+        histogram = "".join(blocks[math.ceil(commits / busiest_hour * (len(blocks) - 1))] for commits in stats["hours"])
+        print("Hour of day".ljust(13) + TerminalStyle.DIM + " [ " + TerminalStyle.CLEAR + TerminalStyle.BLUE + histogram + TerminalStyle.CLEAR + TerminalStyle.DIM + " ] 00-23, busiest " + "%02d:00" % stats["hours"].index(busiest_hour) + TerminalStyle.CLEAR)
+
+    horizontal_line()
+
+
+def print_logs(git_workers):
+
+    horizontal_line()
+
+    all_log_entries = []
+
+    for worker in git_workers:
+        all_log_entries.extend(worker.log_entries())
+
+    all_log_entries.sort(key=lambda x: x.timestamp(), reverse=True)
+
+    longest_date = 0
+    longest_repo = 0
+    longest_author = 0
+
+    for entry in all_log_entries:
+        if len(entry.relative_date()) > longest_date:
+            longest_date = len(entry.relative_date())
+
+        if len(entry.repo()) > longest_repo:
+            longest_repo = len(entry.repo())
+
+        if len(entry.author()) > longest_author:
+            longest_author = len(entry.author())
+
+    term_columns, term_lines = shutil.get_terminal_size((80, 20))
+
+    for entry in all_log_entries:
+        repo_string = entry.repo().ljust(longest_repo)
+        date_string = entry.relative_date().ljust(longest_date)
+        author_string = entry.author().ljust(longest_author)
+
+        meta_data_string = repo_string + TerminalStyle.DIM + " [ " + TerminalStyle.CLEAR + author_string + " " + date_string + TerminalStyle.DIM + " ] " + TerminalStyle.CLEAR
+        message = entry.message()
+        space_remaining = term_columns - len(meta_data_string)
+        message_string = (message[: space_remaining - 3] + "...") if len(message) > space_remaining else message
+
+        print(meta_data_string + TerminalStyle.BLUE + message_string + TerminalStyle.CLEAR)
+
+    horizontal_line()
+
+
+def horizontal_line():
+
+    term_columns, term_lines = shutil.get_terminal_size((80, 20))
+    print(TerminalStyle.DIM + "─" * term_columns + TerminalStyle.CLEAR)
 
 
 def create_workers():
@@ -607,8 +2521,6 @@ def create_workers():
 
     get_repositories(development_dir, git_workers, repo_blacklist)
 
-    git_workers.sort(key=lambda x: x.directory())
-
     return git_workers
 
 
@@ -630,17 +2542,92 @@ def show_help():
     print("gbt pull status")
     print(" - Run 'git pull' on all repositories under development directory, and show status")
     print("")
-    print("gbt checkout <branch_name>")
-    print(" - Run 'git checkout <branch_name>' on all repositories under development directory")
+    print("gbt checkout <branch_name> [--atomic]")
+    print(" - Run 'git checkout <branch_name>' on all repositories under development directory that have the branch locally or on a remote")
+    print("   With --atomic, every repository is switched back to its previous HEAD if any checkout fails")
     print("")
     print("gbt log [<days_to_log>]")
     print(" - Run 'git log' on all repositories under development directory, and display <days_to_log> worth of commits (default 7)")
     print("")
+    print("gbt grep <pattern> [<pathspec>...] [--unordered] [--max-count N]")
+    print(" - Run 'git grep' on all repositories under development directory, streaming matches in repo order (or as they arrive with --unordered), stopping after N matches in total")
+    print("")
+    print("gbt exec [--timeout S] [--fail-fast] -- <command>...")
+    print(" - Run <command> in all repositories under development directory, printing each repository's output as one block followed by an exit status summary")
+    print("")
+    print("gbt clone <manifest> [--per-host N]")
+    print(" - Clone every missing repository listed in <manifest>, at most N at a time from each host (default 4)")
+    print("   Each [<path>] section (relative to home) takes url, and optionally filter (e.g. blob:none), depth, single_branch and branch")
+    print("   Use file:// urls for local repositories, plain paths ignore filter and depth")
+    print("")
+    print("gbt share")
+    print(" - Give repositories cloned from the same upstream one shared object cache (via objects/info/alternates), so fetches transfer objects once")
+    print("")
+    print("gbt unshare")
+    print(" - Copy borrowed objects back into each repository and detach it from its shared object cache")
+    print("")
+    print("gbt maintain")
+    print(" - Write commit-graphs, repack incrementally, prune loose objects and pack refs in all repositories at low CPU and I/O priority, timing status and log before and after")
+    print("")
+    print("gbt tui [--refresh S]")
+    print(" - Browse the status of all repositories full-screen, refreshing every S seconds (default 30) and fetching, pulling or checking out the selected ones")
+    print("")
+    print("gbt stats [--days N] [--format json]")
+    print(" - Count commits per author, repository, day and hour of day (local time) over the last N days (default 30) of every repository's branches")
+    print("")
+    print("gbt prompt")
+    print(" - Print a one-line summary of dirty (\u270e), behind (\u2193), ahead (\u2191) and failing (!) repositories from the last status run, for use in a shell prompt")
+    print("   A trailing ? means the summary is older than prompt_stale_after seconds (default 900)")
+    print("   Prompts should run gbt_prompt.py directly, which prints the same without loading the rest of gbt")
+    print("")
+    print("--background")
+    print(" - Run every git process at idle I/O and lowest CPU priority, run at most background_disk_jobs (default 2) local and background_network_jobs (default 4) fetches or pulls at once,")
+    print("   and hold back new jobs while the 1 minute load average is above background_max_load (default the number of CPUs)")
+    print("   Works with every command, e.g. gbt --background maintain or gbt maintain --background")
+    print("")
+    print("--format json|ndjson")
+    print(" - Print machine-readable records for status, log, fetch and pull instead of text; ndjson streams one record per repository as it completes")
+    print("")
 
 
 # Start program
 
-args = sys.argv[1:]
+option_parser = ArgumentParser(add_help=False)
+option_parser.add_argument("--format", dest="output_format", choices=["text", "json", "ndjson"], default="text")
+option_parser.add_argument("--atomic", action="store_true")
+option_parser.add_argument("--background", action="store_true")
+
+# Global options may come before a subcommand (gbt --background maintain),
+# so the subcommand is the first word that isn't one of them
+
+subcommand_position = 1
+
+while subcommand_position < len(sys.argv) and sys.argv[subcommand_position].startswith("-"):
+    subcommand_position += 2 if sys.argv[subcommand_position] == "--format" else 1
+
+if subcommand_position < len(sys.argv) and sys.argv[subcommand_position] in ["grep", "exec", "clone", "share", "unshare", "maintain", "tui", "stats", "prompt"]:
+    subcommand = sys.argv[subcommand_position]
+    subcommand_args = sys.argv[subcommand_position + 1 :]
+    options = option_parser.parse_args(sys.argv[1:subcommand_position])
+    args = []
+
+    # Every subcommand takes --background, and stats has its own --format,
+    # but anything else given before a subcommand would quietly do nothing
+    if options.output_format != "text" and subcommand == "stats":
+        subcommand_args = ["--format", options.output_format] + subcommand_args
+    elif options.output_format != "text":
+        print("gbt " + subcommand + " doesn't support --format")
+        exit(1)
+
+    if options.atomic:
+        print("gbt " + subcommand + " doesn't support --atomic")
+        exit(1)
+else:
+    subcommand = None
+    subcommand_args = []
+    options, args = option_parser.parse_known_args(sys.argv[1:])
+
+machine_output = options.output_format != "text"
 
 fetch = "fetch" in args
 log = "log" in args
@@ -656,6 +2643,14 @@ if help:
     show_help()
     exit(0)
 
+# Anything else is a typo, and falling back to the default fetch and status would hide it
+
+unknown_args = [arg for index, arg in enumerate(args) if arg not in ["fetch", "log", "pull", "status", "checkout"] and not (index == 1 and (checkout or log))]
+
+if unknown_args:
+    print("unknown argument(s): " + " ".join(unknown_args))
+    exit(1)
+
 if pull and fetch:
     print("fetch and pull are incompatible")
     exit(1)
@@ -683,9 +2678,70 @@ if log:
     if len(args) == 2:
         days_to_log = int(args[1])
 
+# Parse the arguments of commands with their own options, which also take --background
+
+background_parser = ArgumentParser(add_help=False)
+background_parser.add_argument("--background", action="store_true", help="run at low priority with fewer jobs at once, see gbt help")
+
+if subcommand == "grep":
+    grep_parser = ArgumentParser(prog="gbt grep", description="Run 'git grep' in every repository", parents=[background_parser])
+    grep_parser.add_argument("pattern")
+    grep_parser.add_argument("pathspecs", metavar="pathspec", nargs="*")
+    grep_parser.add_argument("--unordered", action="store_true", help="print matches as they arrive instead of in repo order")
+    grep_parser.add_argument("--max-count", type=int, default=0, metavar="N", help="stop after N matches across all repos")
+    subcommand_options = grep_parser.parse_args(subcommand_args)
+
+elif subcommand == "exec":
+    exec_parser = ArgumentParser(prog="gbt exec", description="Run a command in every repository", parents=[background_parser])
+    exec_parser.add_argument("command", nargs="+")
+    exec_parser.add_argument("--timeout", type=float, default=None, metavar="S", help="kill the command in a repo after S seconds")
+    exec_parser.add_argument("--fail-fast", action="store_true", help="cancel outstanding repos after the first failure")
+    subcommand_options = exec_parser.parse_args(subcommand_args)
+
+elif subcommand == "clone":
+    clone_parser = ArgumentParser(prog="gbt clone", description="Clone the repositories listed in a manifest", parents=[background_parser])
+    clone_parser.add_argument("manifest")
+    clone_parser.add_argument("--per-host", type=int, default=4, metavar="N", help="clone at most N repos at a time from one host")
+    subcommand_options = clone_parser.parse_args(subcommand_args)
+
+elif subcommand == "share":
+    share_parser = ArgumentParser(prog="gbt share", description="Share one object cache between clones of the same upstream", parents=[background_parser])
+    subcommand_options = share_parser.parse_args(subcommand_args)
+
+elif subcommand == "unshare":
+    unshare_parser = ArgumentParser(prog="gbt unshare", description="Detach repositories from their shared object cache", parents=[background_parser])
+    subcommand_options = unshare_parser.parse_args(subcommand_args)
+
+elif subcommand == "maintain":
+    maintain_parser = ArgumentParser(prog="gbt maintain", description="Run git housekeeping in every repository", parents=[background_parser])
+    subcommand_options = maintain_parser.parse_args(subcommand_args)
+
+elif subcommand == "tui":
+    tui_parser = ArgumentParser(prog="gbt tui", description="Browse and update repositories full-screen", parents=[background_parser])
+    tui_parser.add_argument("--refresh", type=float, default=30.0, metavar="S", help="refresh every status in the background every S seconds")
+    subcommand_options = tui_parser.parse_args(subcommand_args)
+
+elif subcommand == "stats":
+    stats_parser = ArgumentParser(prog="gbt stats", description="Count commits per author, repository, day and hour", parents=[background_parser])
+    stats_parser.add_argument("--days", type=int, default=30, metavar="N", help="count commits from the last N days")
+    stats_parser.add_argument("--format", dest="output_format", choices=["text", "json"], default="text")
+    subcommand_options = stats_parser.parse_args(subcommand_args)
+
+elif subcommand == "prompt":
+    prompt_parser = ArgumentParser(prog="gbt prompt", description="Print the summary of the last status run for a shell prompt", parents=[background_parser])
+    subcommand_options = prompt_parser.parse_args(subcommand_args)
+
+if subcommand is not None and subcommand_options.background:
+    options.background = True
+
+# gbt prompt only reads the cached summary, so it needs no config or workers
+
+if subcommand == "prompt":
+    sys.exit(print_prompt_summary())
+
 # Set the defaults
 
-if (fetch or pull or status or checkout or log) is False:
+if subcommand is None and (fetch or pull or status or checkout or log) is False:
     fetch = True
     status = True
 
@@ -700,10 +2756,64 @@ development_dir = get_development_dir()
 
 # Do the work
 
+GitStatusWorker.limit_concurrency(get_max_workers())
+GitStatusWorker.set_lock_timeout(get_lock_timeout())
+
+if options.background:
+    lower_process_priority()
+    GitStatusWorker.throttle(*get_background_limits())
+
+if subcommand == "clone":
+    exit(clone_all(subcommand_options.manifest, subcommand_options.per_host))
+
 git_workers = create_workers()
 
-if checkout:
-    checkout_all(git_workers, branch_name)
+if subcommand == "grep":
+    exit(grep_all(git_workers, subcommand_options.pattern, subcommand_options.pathspecs, subcommand_options.unordered, subcommand_options.max_count))
+
+elif subcommand == "share":
+    exit(share_all(git_workers))
+
+elif subcommand == "unshare":
+    exit(unshare_all(git_workers))
+
+elif subcommand == "maintain":
+    exit(maintain_all(git_workers))
+
+elif subcommand == "tui":
+    exit(browse_all(git_workers, subcommand_options.refresh))
+
+elif subcommand == "stats":
+    exit(stats_all(git_workers, subcommand_options.days, subcommand_options.output_format))
+
+elif subcommand == "exec":
+    exit(exec_all(git_workers, subcommand_options.command, subcommand_options.timeout, subcommand_options.fail_fast))
+
+elif checkout:
+    exit(checkout_all(git_workers, branch_name, options.atomic))
+
+elif machine_output:
+    records = []
+
+    if log:
+        log_all(git_workers, days_to_log, show_progress=False)
+        records.extend(print_records(get_repository_workers(git_workers), "log", options.output_format))
+
+    elif pull:
+        pull_all(git_workers, show_progress=False)
+        records.extend(print_records(git_workers, "pull", options.output_format))
+
+    elif fetch:
+        fetch_all(git_workers, show_progress=False)
+        records.extend(print_records(git_workers, "fetch", options.output_format))
+
+    if status:
+        status_all(git_workers)
+        records.extend(print_records(git_workers, "status", options.output_format))
+        write_prompt_summary(git_workers)
+
+    if options.output_format == "json":
+        print(json.dumps(records, indent=2))
 
 elif log:
     log_all(git_workers, days_to_log)
@@ -719,6 +2829,7 @@ else:
     if status:
         status_all(git_workers)
         work_to_do, gbt_has_update = print_statuses(git_workers)
+        write_prompt_summary(git_workers)
 
         if work_to_do is False:
             print(TerminalStyle.GREEN + "Everything up to date" + TerminalStyle.CLEAR)
@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+
+# Prints gbt's cached prompt summary. This runs on every shell prompt, so
+# it is kept apart from gbt.py: a script run directly is compiled from
+# source every time, and this one is small enough for that not to matter
+
+from time import time
+import os
+import struct
+import sys
+
+
+# magic, version, written at, stale after, repos, dirty, behind, ahead, errors
+PROMPT_SUMMARY_FORMAT = "<4sBddIIIII"
+PROMPT_SUMMARY_MAGIC = b"GBTS"
+PROMPT_SUMMARY_VERSION = 1
+
+
+def get_prompt_summary_path():
+
+    return os.path.join(os.path.expanduser("~"), ".cache", "gbt", "prompt.bin")
+
+
+def print_prompt_summary():
+
+    try:
+        with open(get_prompt_summary_path(), "rb") as summary_file:
+            summary = struct.unpack(PROMPT_SUMMARY_FORMAT, summary_file.read(struct.calcsize(PROMPT_SUMMARY_FORMAT)))
+    except (OSError, struct.error):
+        return 0
+
+    magic, version, written_at, stale_after, _, dirty, behind, ahead, errors = summary
+
+    if magic != PROMPT_SUMMARY_MAGIC or version != PROMPT_SUMMARY_VERSION:
+        return 0
+
+    parts = []
+
+    if dirty:
+        parts.append("\u270e" + str(dirty))
+
+    if behind:
+        parts.append("\u2193" + str(behind))
+
+    if ahead:
+        parts.append("\u2191" + str(ahead))
+
+    if errors:
+        parts.append("!" + str(errors))
+
+    if time() - written_at > stale_after:
+        parts.append("?")
+
+    sys.stdout.write(" ".join(parts) + "\n")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(print_prompt_summary())